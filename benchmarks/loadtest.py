@@ -0,0 +1,366 @@
+"""Seed a database, drive one of the APIs with concurrent load, and report latency.
+
+    python benchmarks/loadtest.py links --size 10000
+    python benchmarks/loadtest.py notes --size 1000000 --mode uvicorn --concurrency 64
+    python benchmarks/loadtest.py links --compare benchmarks/results/links-inprocess-10000-abc1234.json
+    python benchmarks/loadtest.py links --scenarios list_links --encoders
+
+Results are written as JSON so runs from different commits can be compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECTS = {
+    "notes": os.path.join(ROOT, "project-a-manual", "backend"),
+    "links": os.path.join(ROOT, "project-b-ai-assisted", "backend"),
+}
+API_KEY = os.getenv("API_KEY", "dev-api-key")
+HEADERS = {"X-API-Key": API_KEY}
+WORDS = (
+    "alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike "
+    "november oscar papa quebec romeo sierra tango uniform victor whiskey xray yankee zulu"
+).split()
+TAGS = ["work", "home", "ideas", "todo", "reading", "python", "travel", "misc"]
+SEED_CHUNK = 50_000
+
+
+def load_backend(project: str, db_path: str):
+    os.environ["DB_PATH"] = db_path
+    sys.path.insert(0, PROJECTS[project])
+    import database
+    import fastjson
+    import main
+    return database, fastjson, main.app
+
+
+def timestamps(size: int):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    step = timedelta(days=365) / max(size, 1)
+    for i in range(size):
+        yield (start + step * i).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def seed_links(database, size: int, rng: random.Random):
+    conns = [database.get_connection(database.shard_path(i)) for i in range(len(database.pools))]
+    shards = [[] for _ in conns]
+    for i, ts in enumerate(timestamps(size)):
+        code = f"s{i:x}"
+        url = f"https://example.com/{i}/{rng.choice(WORDS)}"
+        rows = shards[database.shard_for(code)]
+        rows.append((code, url, database.url_hash(url), rng.randint(0, 1000), ts, ts))
+        if len(rows) >= SEED_CHUNK:
+            insert_links(conns[database.shard_for(code)], rows)
+            rows.clear()
+    for conn, rows in zip(conns, shards):
+        if rows:
+            insert_links(conn, rows)
+        conn.close()
+    return {"codes": [f"s{i:x}" for i in range(size)]}
+
+
+def insert_links(conn, rows):
+    conn.executemany(
+        "INSERT INTO urls (short_code, original_url, url_hash, click_count, created_at, updated_at)"
+        " VALUES (?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    conn.commit()
+
+
+def seed_notes(database, size: int, rng: random.Random):
+    conn = database.get_connection()
+    rows = []
+    for i, ts in enumerate(timestamps(size)):
+        title = f"Note {i} {rng.choice(WORDS)}"
+        body = " ".join(rng.choices(WORDS, k=rng.randint(20, 200)))
+        tags = json.dumps(rng.sample(TAGS, rng.randint(0, 3)))
+        rows.append((title, body, len(body), tags, ts, ts))
+        if len(rows) >= SEED_CHUNK:
+            insert_notes(conn, rows)
+            rows = []
+    if rows:
+        insert_notes(conn, rows)
+    conn.execute(
+        "INSERT OR IGNORE INTO note_tags (tag, note_id)"
+        " SELECT json_each.value, notes.id FROM notes, json_each(notes.tags)"
+    )
+    conn.commit()
+    conn.close()
+    return {"ids": size}
+
+
+def insert_notes(conn, rows):
+    conn.executemany(
+        "INSERT INTO notes (title, body, body_length, tags, created_at, updated_at)"
+        " VALUES (?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    conn.commit()
+
+
+def hot_code(state, rng):
+    codes = state["codes"]
+    # 80% of traffic goes to the hottest 1% of links.
+    if rng.random() < 0.8:
+        return codes[rng.randrange(max(len(codes) // 100, 1))]
+    return codes[rng.randrange(len(codes))]
+
+
+SCENARIOS = {
+    "links": {
+        "redirect": lambda s, r: ("GET", f"/{hot_code(s, r)}", None),
+        "create_link": lambda s, r: (
+            "POST", "/api/links", {"original_url": f"https://bench.example/{uuid.uuid4().hex}"}
+        ),
+        "list_links": lambda s, r: ("GET", "/api/links", None),
+        "get_stats": lambda s, r: ("GET", f"/api/links/{hot_code(s, r)}/stats", None),
+    },
+    "notes": {
+        "list_notes": lambda s, r: ("GET", "/api/notes", None),
+        "search_notes": lambda s, r: ("GET", f"/api/notes/search?q={r.choice(WORDS)}", None),
+        "get_note": lambda s, r: ("GET", f"/api/notes/{r.randint(1, s['ids'])}", None),
+        "update_note": lambda s, r: (
+            "PUT", f"/api/notes/{r.randint(1, s['ids'])}", {"title": f"Edited {r.choice(WORDS)}"}
+        ),
+    },
+}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+async def drive(client, make_request, state, requests: int, concurrency: int, seed: int):
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def worker(worker_id):
+        nonlocal remaining, errors
+        rng = random.Random(seed * 1000 + worker_id)
+        while remaining > 0:
+            remaining -= 1
+            method, url, body = make_request(state, rng)
+            start = time.perf_counter()
+            try:
+                r = await client.request(method, url, json=body, headers=HEADERS)
+                if r.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+    }
+
+
+async def run_scenarios(client, project, state, args):
+    results = {}
+    for name in args.scenarios:
+        make_request = SCENARIOS[project][name]
+        if args.warmup:
+            await drive(client, make_request, state, args.warmup, args.concurrency, args.seed)
+        results[name] = await drive(
+            client, make_request, state, args.requests, args.concurrency, args.seed
+        )
+        print(f"{name:>14}: {format_result(results[name])}")
+    return results
+
+
+def format_result(r):
+    return (
+        f"{r['throughput_rps']:>9} req/s  p50 {r['p50_ms']:>8} ms  p95 {r['p95_ms']:>8} ms"
+        f"  p99 {r['p99_ms']:>8} ms  errors {r['errors']}"
+    )
+
+
+async def run_inprocess(app, project, state, args):
+    transport = httpx.ASGITransport(app=app)
+    limits = httpx.Limits(max_connections=None)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", limits=limits
+        ) as client:
+            return await run_scenarios(client, project, state, args)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run_uvicorn(project, state, args, db_path, fast_json):
+    port = free_port()
+    env = {**os.environ, "DB_PATH": db_path, "FAST_JSON": "1" if fast_json else "0"}
+    cmd = [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(args.workers), "--log-level", "warning",
+    ]
+    server = subprocess.Popen(cmd, cwd=PROJECTS[project], env=env)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+            for _ in range(100):
+                try:
+                    if (await client.get("/health")).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("uvicorn did not come up")
+            return await run_scenarios(client, project, state, args)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def run(app, fastjson, project, state, args, db_path, fast_json):
+    print(f"FAST_JSON={int(fast_json)}")
+    if args.mode == "inprocess":
+        fastjson.ENABLED = fast_json
+        return asyncio.run(run_inprocess(app, project, state, args))
+    return asyncio.run(run_uvicorn(project, state, args, db_path, fast_json))
+
+
+def side_by_side(model, fast):
+    print(f"\n{'':>14}  {'model req/s':>12} {'orjson req/s':>12} {'change':>8}"
+          f"  {'model p99':>10} {'orjson p99':>10} {'change':>8}")
+    for name, before in model.items():
+        now = fast[name]
+        rps = (now["throughput_rps"] / before["throughput_rps"] - 1) * 100
+        p99 = (now["p99_ms"] / before["p99_ms"] - 1) * 100
+        print(f"{name:>14}  {before['throughput_rps']:>12} {now['throughput_rps']:>12} {rps:>+7.1f}%"
+              f"  {before['p99_ms']:>10} {now['p99_ms']:>10} {p99:>+7.1f}%")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(current, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"\ncompared with {previous['commit']} ({previous_path})")
+    for name, now in current["scenarios"].items():
+        before = previous["scenarios"].get(name)
+        if not before:
+            continue
+        rps = (now["throughput_rps"] / before["throughput_rps"] - 1) * 100
+        p99 = (now["p99_ms"] / before["p99_ms"] - 1) * 100
+        print(f"{name:>14}: throughput {rps:+.1f}%  p99 {p99:+.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("project", choices=sorted(PROJECTS))
+    parser.add_argument("--size", type=int, default=10_000, help="rows to seed")
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn"], default="inprocess")
+    parser.add_argument("--scenarios", nargs="+", help="default: all for the project")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="reuse or create the seeded database at this path")
+    parser.add_argument("--output", help="where to write the JSON results")
+    parser.add_argument("--compare", help="previous results file to diff against")
+    parser.add_argument(
+        "--encoders", action="store_true",
+        help="run every scenario with FAST_JSON off and on and report them side by side",
+    )
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or list(SCENARIOS[args.project])
+    unknown = set(args.scenarios) - set(SCENARIOS[args.project])
+    if unknown:
+        parser.error(f"unknown scenarios for {args.project}: {', '.join(sorted(unknown))}")
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="bench-"), f"{args.project}.db")
+    fresh = not os.path.exists(db_path)
+    database, fastjson, app = load_backend(args.project, db_path)
+    database.init_db()
+    rng = random.Random(args.seed)
+    seeder = seed_links if args.project == "links" else seed_notes
+    start = time.perf_counter()
+    if fresh:
+        state = seeder(database, args.size, rng)
+        print(f"seeded {args.size} rows into {db_path} in {time.perf_counter() - start:.1f}s")
+    elif args.project == "links":
+        state = {"codes": [f"s{i:x}" for i in range(args.size)]}
+    else:
+        state = {"ids": args.size}
+
+    fast_json = None
+    if args.encoders:
+        scenarios = run(app, fastjson, args.project, state, args, db_path, False)
+        fast_json = run(app, fastjson, args.project, state, args, db_path, True)
+        side_by_side(scenarios, fast_json)
+    else:
+        scenarios = run(app, fastjson, args.project, state, args, db_path, fastjson.ENABLED)
+
+    commit = git_commit()
+    result = {
+        "project": args.project,
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "mode": args.mode,
+        "size": args.size,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "workers": args.workers if args.mode == "uvicorn" else None,
+        "python": platform.python_version(),
+        "scenarios": scenarios,
+    }
+    if fast_json is not None:
+        # "scenarios" holds the FAST_JSON=0 run so --compare still lines up with plain runs.
+        result["scenarios_fast_json"] = fast_json
+    output = args.output or os.path.join(
+        ROOT, "benchmarks", "results", f"{args.project}-{args.mode}-{args.size}-{commit}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"results written to {output}")
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+
+from metrics import Counter, Gauge, Histogram, registry
+
+ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+EXEMPT_PATHS = {"/health", "/metrics"}
+
+admitted = registry.register(Counter(
+    "admission_admitted_total", "Requests let through admission control.", ("class",)
+))
+rejected = registry.register(Counter(
+    "admission_rejected_total", "Requests shed with a 503.", ("class", "reason")
+))
+in_flight = registry.register(Gauge(
+    "admission_in_flight", "Admitted requests still running.", ("class",)
+))
+queued = registry.register(Gauge(
+    "admission_queued", "Requests waiting for a slot.", ("class",)
+))
+queue_wait = registry.register(Histogram(
+    "admission_queue_wait_seconds", "Time spent waiting for a slot.", ("class",)
+))
+
+
+class Limiter:
+    """Concurrency limit with a bounded FIFO queue and a queue-wait budget.
+
+    Requests that would wait longer than budget seconds are shed. The wait is also
+    tracked as a moving average; while it sits above the budget, requests that
+    would have to queue are shed straight away instead of waiting to time out.
+    Runs on the event loop only, so it needs no lock.
+    """
+
+    def __init__(self, name: str, concurrency: int, queue_size: int, budget: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.budget = budget
+        self.active = 0
+        self.wait_avg = 0.0
+        self._waiters = deque()
+
+    def _observe(self, waited: float):
+        self.wait_avg = 0.8 * self.wait_avg + 0.2 * waited
+        queue_wait.observe(waited, self.name)
+
+    def _reject(self, reason: str) -> bool:
+        rejected.inc(self.name, reason)
+        return False
+
+    async def acquire(self) -> bool:
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            self._observe(0.0)
+            return True
+        if len(self._waiters) >= self.queue_size:
+            return self._reject("queue_full")
+        if self.wait_avg >= self.budget:
+            return self._reject("overloaded")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        queued.set(self.name, value=len(self._waiters))
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, self.budget)
+        except asyncio.TimeoutError:
+            self._observe(time.perf_counter() - start)
+            return self._reject("budget")
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            queued.set(self.name, value=len(self._waiters))
+        self._observe(time.perf_counter() - start)
+        return True
+
+    def release(self):
+        # Hand the slot straight to the next live waiter so nobody can jump the queue.
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def reset(self):
+        self.active = 0
+        self.wait_avg = 0.0
+        self._waiters.clear()
+
+
+def limiter_from_env(name: str, concurrency: int, queue_size: int, budget: float) -> Limiter:
+    prefix = f"ADMISSION_{name.upper()}"
+    return Limiter(
+        name,
+        int(os.getenv(f"{prefix}_CONCURRENCY", str(concurrency))),
+        int(os.getenv(f"{prefix}_QUEUE", str(queue_size))),
+        float(os.getenv(f"{prefix}_BUDGET", str(budget))),
+    )
+
+
+class AdmissionController:
+    def __init__(self, limiters: dict[str, Limiter]):
+        self.limiters = limiters
+
+    def route_class(self, scope):
+        if scope["path"] in EXEMPT_PATHS:
+            return None
+        return "write" if scope["method"] in WRITE_METHODS else "read"
+
+
+admission = AdmissionController({
+    "write": limiter_from_env("write", 16, 128, 0.5),
+    "read": limiter_from_env("read", 64, 512, 1.0),
+})
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, controller: AdmissionController = admission):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENABLED:
+            await self.app(scope, receive, send)
+            return
+        name = self.controller.route_class(scope)
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+        limiter = self.controller.limiters[name]
+        if not await limiter.acquire():
+            await send_busy(send)
+            return
+        admitted.inc(name)
+        in_flight.inc(name)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            in_flight.dec(name)
+            limiter.release()
+
+
+async def send_busy(send):
+    body = json.dumps({"detail": "Server busy, retry later"}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(RETRY_AFTER).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,21 @@
+import os
+import zlib
+
+# Bodies longer than this many characters are stored zlib-compressed in note_bodies,
+# and notes.body keeps only the first PREVIEW_CHARS for listings.
+THRESHOLD = int(os.getenv("NOTES_COMPRESS_THRESHOLD", "8192"))
+PREVIEW_CHARS = int(os.getenv("NOTES_PREVIEW_CHARS", "280"))
+
+
+def pack(body: str) -> tuple[str, bytes | None]:
+    """Split a body into what goes in notes.body and the compressed copy, if any."""
+    if len(body) <= THRESHOLD:
+        return body, None
+    return body[:PREVIEW_CHARS], zlib.compress(body.encode())
+
+
+def inflate(packed: bytes | None) -> str | None:
+    # Registered as an SQL function on every connection; the search index reads bodies through it.
+    if packed is None:
+        return None
+    return zlib.decompress(packed).decode()
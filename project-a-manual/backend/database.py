@@ -1,20 +1,170 @@
 import sqlite3
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "notes.db")
+import bodies
+from metrics import TimedConnection, stage_duration
+
+DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.dirname(__file__), "notes.db"))
+
+# Starlette runs sync routes on anyio's default threadpool, which has 40 workers.
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "40"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA mmap_size={int(os.getenv('DB_MMAP_SIZE', str(256 * 1024 * 1024)))}",
+    f"PRAGMA cache_size={int(os.getenv('DB_CACHE_SIZE', '-16000'))}",
+    f"PRAGMA busy_timeout={int(os.getenv('DB_BUSY_TIMEOUT', '5000'))}",
+)
 
 
 def get_connection():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
+    conn.create_function("inflate", 1, bodies.inflate, deterministic=True)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
-def init_db():
-    conn = get_connection()
-    conn.execute("""
+class ConnectionPool:
+    def __init__(self, size: int, timeout: float):
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._acquired = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+        if conn is None:
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    with stage_duration.time("connection_open"):
+                        conn = get_connection()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                start = time.perf_counter()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError("Timed out waiting for a database connection")
+                waited = time.perf_counter() - start
+                with self._lock:
+                    self._waits += 1
+                    self._wait_total += waited
+                    self._wait_max = max(self._wait_max, waited)
+        with self._lock:
+            self._acquired += 1
+        return conn
+
+    def _release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._opened,
+                "idle": self._idle.qsize(),
+                "acquired": self._acquired,
+                "waits": self._waits,
+                "wait_seconds_total": self._wait_total,
+                "wait_seconds_max": self._wait_max,
+            }
+
+
+pool = ConnectionPool(POOL_SIZE, POOL_TIMEOUT)
+
+
+def get_db():
+    with pool.connection() as conn:
+        yield conn
+
+
+def table_version_steps(table: str) -> list[str]:
+    """Create table_versions and triggers that bump table's row on every write."""
+    bump = (
+        "UPDATE table_versions SET version = version + 1, updated_at = datetime('now')"
+        f" WHERE name = '{table}'"
+    )
+    return [
+        "CREATE TABLE IF NOT EXISTS table_versions ("
+        " name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0,"
+        " updated_at TEXT NOT NULL DEFAULT (datetime('now')))",
+        f"INSERT OR IGNORE INTO table_versions (name) VALUES ('{table}')",
+    ] + [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table}"
+        f" BEGIN {bump}; END"
+        for event in ("INSERT", "UPDATE", "DELETE")
+    ]
+
+
+def compress_bodies(conn):
+    rows = conn.execute("SELECT id, body FROM notes WHERE length(body) > ?", (bodies.THRESHOLD,))
+    for row in rows.fetchall():
+        preview, packed = bodies.pack(row["body"])
+        conn.execute("INSERT INTO note_bodies (note_id, body) VALUES (?, ?)", (row["id"], packed))
+        conn.execute("UPDATE notes SET body = ? WHERE id = ?", (preview, row["id"]))
+
+
+# The search index holds the full text: note_bodies when a body is compressed, else notes.body.
+FTS_TEXT = "COALESCE(inflate((SELECT body FROM note_bodies WHERE note_id = {0}.id)), {0}.body)"
+
+# Every write to notes takes the next value, so committed changes are numbered in commit order.
+NEXT_CHANGE = "UPDATE sequences SET value = value + 1 WHERE name = 'note_changes'"
+CURRENT_CHANGE = "(SELECT value FROM sequences WHERE name = 'note_changes')"
+
+# Each entry upgrades the schema by one PRAGMA user_version. Steps are SQL or callables.
+MIGRATIONS = [
+    [
+        """
         CREATE TABLE IF NOT EXISTS notes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             title TEXT NOT NULL,
@@ -23,6 +173,200 @@ def init_db():
             created_at TEXT NOT NULL DEFAULT (datetime('now')),
             updated_at TEXT NOT NULL DEFAULT (datetime('now'))
         )
-    """)
-    conn.commit()
-    conn.close()
+        """,
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_notes_created_at ON notes (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_notes_updated_at ON notes (updated_at)",
+    ],
+    table_version_steps("notes"),
+    [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            title, body, content='notes', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, title, body) VALUES (new.id, new.title, new.body);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, body)
+            VALUES ('delete', old.id, old.title, old.body);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF title, body ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, body)
+            VALUES ('delete', old.id, old.title, old.body);
+            INSERT INTO notes_fts (rowid, title, body) VALUES (new.id, new.title, new.body);
+        END
+        """,
+        "INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS note_tags (
+            tag TEXT NOT NULL,
+            note_id INTEGER NOT NULL REFERENCES notes (id) ON DELETE CASCADE,
+            PRIMARY KEY (tag, note_id)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_note_tags_note_id ON note_tags (note_id)",
+        """
+        INSERT OR IGNORE INTO note_tags (tag, note_id)
+        SELECT json_each.value, notes.id FROM notes, json_each(notes.tags)
+        WHERE json_valid(notes.tags)
+        """,
+    ],
+    [
+        "ALTER TABLE notes ADD COLUMN body_length INTEGER NOT NULL DEFAULT 0",
+        "UPDATE notes SET body_length = length(body)",
+        """
+        CREATE TABLE IF NOT EXISTS note_bodies (
+            note_id INTEGER PRIMARY KEY REFERENCES notes (id) ON DELETE CASCADE,
+            body BLOB NOT NULL
+        )
+        """,
+        "DROP TRIGGER IF EXISTS notes_fts_insert",
+        "DROP TRIGGER IF EXISTS notes_fts_delete",
+        "DROP TRIGGER IF EXISTS notes_fts_update",
+        "DROP TABLE IF EXISTS notes_fts",
+        compress_bodies,
+        # snippet() and 'rebuild' read the full text through this view.
+        """
+        CREATE VIEW IF NOT EXISTS note_text AS
+        SELECT notes.id, notes.title, COALESCE(inflate(note_bodies.body), notes.body) AS body
+        FROM notes LEFT JOIN note_bodies ON note_bodies.note_id = notes.id
+        """,
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            title, body, content='note_text', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+        """,
+        "INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, title, body)
+            VALUES (new.id, new.title, {FTS_TEXT.format("new")});
+        END
+        """,
+        # BEFORE, because the note_bodies row is cascaded away before AFTER triggers run.
+        f"""
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete BEFORE DELETE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, body)
+            VALUES ('delete', old.id, old.title, {FTS_TEXT.format("old")});
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF title, body ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, body)
+            VALUES ('delete', old.id, old.title, {FTS_TEXT.format("old")});
+            INSERT INTO notes_fts (rowid, title, body)
+            VALUES (new.id, new.title, {FTS_TEXT.format("new")});
+        END
+        """,
+        # Writes to note_bodies swap the indexed text between the preview and the full body.
+        # Selecting from notes makes them no-ops when the note itself is being deleted.
+        """
+        CREATE TRIGGER IF NOT EXISTS note_bodies_fts_insert AFTER INSERT ON note_bodies BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, body)
+            SELECT 'delete', id, title, body FROM notes WHERE id = new.note_id;
+            INSERT INTO notes_fts (rowid, title, body)
+            SELECT id, title, inflate(new.body) FROM notes WHERE id = new.note_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS note_bodies_fts_update AFTER UPDATE ON note_bodies BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, body)
+            SELECT 'delete', id, title, inflate(old.body) FROM notes WHERE id = old.note_id;
+            INSERT INTO notes_fts (rowid, title, body)
+            SELECT id, title, inflate(new.body) FROM notes WHERE id = new.note_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS note_bodies_fts_delete AFTER DELETE ON note_bodies BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, body)
+            SELECT 'delete', id, title, inflate(old.body) FROM notes WHERE id = old.note_id;
+            INSERT INTO notes_fts (rowid, title, body)
+            SELECT id, title, body FROM notes WHERE id = old.note_id;
+        END
+        """,
+    ],
+    [
+        "ALTER TABLE notes ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0",
+        """
+        CREATE TABLE IF NOT EXISTS sequences (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS note_tombstones (
+            note_id INTEGER PRIMARY KEY,
+            change_seq INTEGER NOT NULL,
+            deleted_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+        """,
+        # Existing notes are numbered in the order they were last written.
+        """
+        UPDATE notes SET change_seq = ranked.seq
+        FROM (SELECT id, row_number() OVER (ORDER BY updated_at, id) AS seq FROM notes) AS ranked
+        WHERE ranked.id = notes.id
+        """,
+        "INSERT OR IGNORE INTO sequences (name, value) SELECT 'note_changes', COUNT(*) FROM notes",
+        "CREATE INDEX IF NOT EXISTS idx_notes_change_seq ON notes (change_seq)",
+        "CREATE INDEX IF NOT EXISTS idx_note_tombstones_change_seq ON note_tombstones (change_seq)",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS notes_change_insert AFTER INSERT ON notes BEGIN
+            {NEXT_CHANGE};
+            UPDATE notes SET change_seq = {CURRENT_CHANGE} WHERE id = new.id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS notes_change_update
+        AFTER UPDATE OF title, body, body_length, tags, created_at, updated_at ON notes BEGIN
+            {NEXT_CHANGE};
+            UPDATE notes SET change_seq = {CURRENT_CHANGE} WHERE id = new.id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS notes_change_delete AFTER DELETE ON notes BEGIN
+            {NEXT_CHANGE};
+            INSERT OR REPLACE INTO note_tombstones (note_id, change_seq) VALUES (old.id, {CURRENT_CHANGE});
+        END
+        """,
+    ],
+]
+
+
+def migrate(conn):
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(MIGRATIONS):
+            conn.commit()
+            return version
+        try:
+            for step in MIGRATIONS[version]:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def init_db():
+    conn = get_connection()
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
@@ -1,27 +1,73 @@
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
-from database import init_db
+from admission import AdmissionMiddleware
+from database import init_db, pool
+from metrics import MetricsMiddleware, TimedJSONResponse, registry
 from routes.notes import router as notes_router
+from search_cache import search_cache
+from suggest import suggest_index
 
 
 @asynccontextmanager
 async def lifespan(app):
     init_db()
+    suggest_index.start()
     yield
+    suggest_index.stop()
+    pool.close()
 
 
-app = FastAPI(title="Notes API", version="0.1.0", lifespan=lifespan)
+@registry.collector
+def runtime_stats():
+    db = pool.stats()
+    cache = search_cache.stats()
+    suggestions = suggest_index.stats()
+    return [
+        ("db_pool_open_connections", "gauge", "Open pooled SQLite connections.", db["open"]),
+        ("db_pool_idle_connections", "gauge", "Idle pooled SQLite connections.", db["idle"]),
+        ("db_pool_acquired_total", "counter", "Connections handed out by the pool.", db["acquired"]),
+        ("db_pool_waits_total", "counter", "Acquisitions that had to wait.", db["waits"]),
+        ("db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection.", db["wait_seconds_total"]),
+        ("db_pool_wait_seconds_max", "gauge", "Longest wait for a connection.", db["wait_seconds_max"]),
+        ("search_cache_entries", "gauge", "Cached search results.", cache["size"]),
+        ("search_cache_bytes", "gauge", "Estimated memory held by cached search results.", cache["bytes"]),
+        ("search_cache_hits_total", "counter", "Searches answered from the cache.", cache["hits"]),
+        ("search_cache_misses_total", "counter", "Searches that ran the query.", cache["misses"]),
+        ("search_cache_stale_total", "counter", "Misses on entries from an older notes generation.", cache["stale"]),
+        ("search_cache_evictions_total", "counter", "Entries pushed out by the size or memory limit.", cache["evictions"]),
+        ("search_cache_hit_ratio", "gauge", "Share of searches answered from the cache.", cache["hit_ratio"]),
+        ("suggest_index_titles", "gauge", "Distinct titles in the suggest index.", suggestions["titles"]),
+        ("suggest_index_tags", "gauge", "Distinct tags in the suggest index.", suggestions["tags"]),
+    ]
+
+
+app = FastAPI(
+    title="Notes API",
+    version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=TimedJSONResponse,
+)
+# Innermost, so shed requests still get CORS headers and show up in request metrics.
+app.add_middleware(AdmissionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+app.add_middleware(MetricsMiddleware)
 app.include_router(notes_router)
 
 
 @app.get("/health")
 def health():
     return {"status": "ok"}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
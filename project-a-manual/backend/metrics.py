@@ -0,0 +1,286 @@
+import re
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from fastapi.responses import JSONResponse
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def format_labels(names, values, extra=None) -> str:
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for values, value in items:
+            yield self.name, format_labels(self.labels, values), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def samples(self):
+        with self._lock:
+            items = [(values, list(s[0]), s[1], s[2]) for values, s in self._series.items()]
+        for values, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = f'le="{format_value(bound)}"'
+                yield f"{self.name}_bucket", format_labels(self.labels, values, le), cumulative
+            labels = format_labels(self.labels, values)
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """Register fn() -> [(name, kind, help, value)] to be sampled at scrape time."""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {format_value(value)}")
+        for fn in self._collectors:
+            for name, kind, help, value in fn():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route.", ("method", "handler", "status")
+))
+requests_in_flight = registry.register(Gauge(
+    "http_requests_in_flight", "HTTP requests currently being served.", ("method",)
+))
+query_duration = registry.register(Histogram(
+    "sqlite_query_duration_seconds", "SQLite statement execution time by statement label.", ("statement",)
+))
+stage_duration = registry.register(Histogram(
+    "app_stage_duration_seconds", "Time spent in a named stage of request handling.", ("stage",)
+))
+
+TABLE_RE = re.compile(
+    r"\b(?:FROM|INTO|UPDATE|JOIN|TABLE|ON)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)", re.IGNORECASE
+)
+_labels = {}
+
+
+def statement_label(sql: str) -> str:
+    label = _labels.get(sql)
+    if label is None:
+        words = sql.split(None, 1)
+        verb = words[0].lower() if words else "other"
+        match = TABLE_RE.search(sql)
+        label = f"{verb} {match.group(1)}" if match else verb
+        if len(_labels) < 1000:
+            _labels[sql] = label
+    return label
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Times a statement from execute() until its rows are all fetched.
+
+    The total is observed once, so large reads count their fetch time and each
+    statement still adds one sample to its label.
+    """
+
+    _label = None
+    _elapsed = 0.0
+
+    def _finish(self):
+        if self._label is not None:
+            query_duration.observe(self._elapsed, self._label)
+            self._label = None
+
+    def _run(self, method, sql, args):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            self._elapsed = time.perf_counter() - start
+            self._label = statement_label(sql)
+            if self.description is None:
+                self._finish()
+
+    def execute(self, sql, *args):
+        return self._run(super().execute, sql, args)
+
+    def executemany(self, sql, *args):
+        return self._run(super().executemany, sql, args)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._elapsed += time.perf_counter() - start
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        start = time.perf_counter()
+        rows = super().fetchmany(*args, **kwargs)
+        self._elapsed += time.perf_counter() - start
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._elapsed += time.perf_counter() - start
+        self._finish()
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._elapsed += time.perf_counter() - start
+            self._finish()
+            raise
+        self._elapsed += time.perf_counter() - start
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # Single-row reads (execute(...).fetchone()) are observed when the cursor is dropped.
+        self._finish()
+
+
+class TimedConnection(sqlite3.Connection):
+    def execute(self, sql, *args):
+        return self.cursor(TimedCursor).execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor(TimedCursor).executemany(sql, *args)
+
+
+class TimedJSONResponse(JSONResponse):
+    """Default response class that records JSON encoding as the "serialize" stage."""
+
+    def render(self, content) -> bytes:
+        with stage_duration.time("serialize"):
+            return super().render(content)
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        method = scope["method"]
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        requests_in_flight.inc(method)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            requests_in_flight.dec(method)
+            endpoint = scope.get("endpoint")
+            handler = getattr(endpoint, "__name__", "unmatched")
+            request_duration.observe(elapsed, method, handler, status)
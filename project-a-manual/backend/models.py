@@ -8,6 +8,11 @@ class NoteCreate(BaseModel):
     tags: list[str] = []
 
 
+class NoteImport(NoteCreate):
+    created_at: Optional[str] = Field(default=None, pattern=r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$")
+    updated_at: Optional[str] = Field(default=None, pattern=r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$")
+
+
 class NoteUpdate(BaseModel):
     title: Optional[str] = Field(default=None, min_length=1, max_length=200)
     body: Optional[str] = None
@@ -17,7 +22,40 @@ class NoteUpdate(BaseModel):
 class NoteResponse(BaseModel):
     id: int
     title: str
+    # Listings carry a preview of long bodies; body_length is the full length.
     body: str
+    body_length: int
     tags: list[str]
     created_at: str
     updated_at: str
+
+
+class NoteSearchResult(NoteResponse):
+    snippet: Optional[str] = None
+
+
+class TagCount(BaseModel):
+    tag: str
+    count: int
+
+
+class Suggestion(BaseModel):
+    text: str
+    count: int
+
+
+class NoteChanges(BaseModel):
+    notes: list[NoteResponse]
+    deleted: list[int]
+    token: str
+    has_more: bool
+
+
+class ImportLineError(BaseModel):
+    line: int
+    detail: str
+
+
+class ImportResult(BaseModel):
+    imported: int
+    errors: list[ImportLineError]
@@ -1,100 +1,513 @@
+import base64
 import json
+import os
+import re
+import sqlite3
 from datetime import datetime, timezone
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 
+import bodies
+import conditional
+import fastjson
 from auth import verify_api_key
-from database import get_connection
-from models import NoteCreate, NoteUpdate, NoteResponse
+from database import get_db, pool
+from metrics import stage_duration
+from models import (
+    ImportLineError, ImportResult, NoteChanges, NoteCreate, NoteImport, NoteResponse,
+    NoteSearchResult, NoteUpdate, Suggestion, TagCount,
+)
+from search_cache import rows_size, search_cache
+from suggest import suggest_index
 
 router = APIRouter(prefix="/api/notes", tags=["notes"], dependencies=[Depends(verify_api_key)])
 
+SEARCH_TERM_RE = re.compile(r'"([^"]*)"|(\S+)')
+# Title hits count ten times as much as body hits.
+RANK = "bm25(notes_fts, 10.0, 1.0)"
+SNIPPET = "snippet(notes_fts, -1, '<mark>', '</mark>', '…', 12)"
+NOTE_FIELDS = ("id", "title", "body", "body_length", "tags", "created_at", "updated_at")
+# notes.body is only a preview for compressed notes; this reads the whole body.
+FULL_NOTE_SQL = (
+    "SELECT notes.id, notes.title, COALESCE(inflate(note_bodies.body), notes.body) AS body,"
+    " notes.body_length, notes.tags, notes.created_at, notes.updated_at, notes.change_seq"
+    " FROM notes LEFT JOIN note_bodies ON note_bodies.note_id = notes.id"
+)
+PAGE_SIZE = int(os.getenv("NOTES_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = 1000
+CHANGES_SQL = (
+    f"SELECT *, 0 AS deleted FROM ({FULL_NOTE_SQL}"
+    " WHERE notes.change_seq > ? ORDER BY notes.change_seq LIMIT ?)"
+    " UNION ALL"
+    " SELECT * FROM (SELECT note_id, NULL, NULL, NULL, NULL, NULL, NULL, change_seq, 1"
+    " FROM note_tombstones WHERE change_seq > ? ORDER BY change_seq LIMIT ?)"
+    " ORDER BY change_seq LIMIT ?"
+)
+IMPORT_CHUNK_SIZE = int(os.getenv("NOTES_IMPORT_CHUNK_SIZE", "1000"))
+EXPORT_BATCH_SIZE = int(os.getenv("NOTES_EXPORT_BATCH_SIZE", "1000"))
+
 
 def row_to_note(row) -> NoteResponse:
     return NoteResponse(
         id=row["id"],
         title=row["title"],
         body=row["body"],
+        body_length=row["body_length"],
         tags=json.loads(row["tags"]),
         created_at=row["created_at"],
         updated_at=row["updated_at"],
     )
 
 
+def fts_query(q: str) -> str | None:
+    """Turn user input into an FTS5 query: words AND-ed, "quoted phrases", trailing * for prefixes.
+
+    Every term is quoted, so FTS5 operators in the input are matched as text.
+    """
+    terms = []
+    for phrase, word in SEARCH_TERM_RE.findall(q):
+        text = phrase if phrase else word.replace('"', "")
+        prefix = not phrase and text.endswith("*")
+        text = text.rstrip("*").strip()
+        if text:
+            terms.append(f'"{text}"' + ("*" if prefix else ""))
+    return " ".join(terms) or None
+
+
+def write_tags(conn, note_id: int, tags: list[str], replace: bool = False):
+    if replace:
+        conn.execute("DELETE FROM note_tags WHERE note_id = ?", (note_id,))
+    conn.executemany(
+        "INSERT OR IGNORE INTO note_tags (tag, note_id) VALUES (?, ?)",
+        [(tag, note_id) for tag in tags],
+    )
+
+
+def write_body(conn, note_id: int, packed: bytes | None, replace: bool = False):
+    if packed is not None:
+        conn.execute(
+            "INSERT INTO note_bodies (note_id, body) VALUES (?, ?)"
+            " ON CONFLICT (note_id) DO UPDATE SET body = excluded.body",
+            (note_id, packed),
+        )
+    elif replace:
+        conn.execute("DELETE FROM note_bodies WHERE note_id = ?", (note_id,))
+
+
+def tag_filter(tags: list[str], mode: str) -> tuple[str, list]:
+    tags = list(dict.fromkeys(tags))
+    marks = ", ".join("?" for _ in tags)
+    if mode == "any":
+        return f"notes.id IN (SELECT note_id FROM note_tags WHERE tag IN ({marks}))", tags
+    return (
+        f"notes.id IN (SELECT note_id FROM note_tags WHERE tag IN ({marks})"
+        " GROUP BY note_id HAVING COUNT(*) = ?)",
+        tags + [len(tags)],
+    )
+
+
+def row_to_search_result(row) -> NoteSearchResult:
+    return NoteSearchResult(**row_to_note(row).model_dump(), snippet=row["snippet"])
+
+
+def parse_fields(fields: str | None, allowed: tuple[str, ...]) -> list[str] | None:
+    if fields is None:
+        return None
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    unknown = [name for name in names if name not in allowed]
+    if not names or unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(unknown)}; allowed: {', '.join(allowed)}",
+        )
+    return names
+
+
+def select_columns(names: list[str] | None, *keys: str) -> str:
+    """Columns to read: the requested fields plus whatever the page cursor needs."""
+    if names is None:
+        return "notes.*"
+    wanted = dict.fromkeys(["id", *keys, *names])
+    return ", ".join(f"notes.{name}" for name in wanted if name in NOTE_FIELDS)
+
+
+def encode_cursor(kind: str, *key) -> str:
+    return base64.urlsafe_b64encode(json.dumps([kind, *key]).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, kind: str, size: int = 2) -> list:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        key = None
+    if not isinstance(key, list) or len(key) != size + 1 or key[0] != kind:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key[1:]
+
+
+def fetch_page(conn, sql: str, params: list, limit: int | None, kind: str, *key: str):
+    """Run sql (already ordered by key) and return up to limit rows and the next page's cursor.
+
+    One extra row is fetched to know whether there's a next page. The cursor holds
+    the key of the last row, so the next page seeks straight to it through the
+    index instead of skipping rows like OFFSET.
+    """
+    if limit is not None:
+        sql += " LIMIT ?"
+        params = [*params, limit + 1]
+    rows = conn.execute(sql, params).fetchall()
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(kind, *(rows[-1][name] for name in key))
+    return rows, None
+
+
+def project(row, names: list[str]) -> dict:
+    return {name: fastjson.raw(row[name]) if name == "tags" else row[name] for name in names}
+
+
 @router.post("", response_model=NoteResponse, status_code=201)
-def create_note(note: NoteCreate):
-    conn = get_connection()
+def create_note(note: NoteCreate, conn: sqlite3.Connection = Depends(get_db)):
     now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    preview, packed = bodies.pack(note.body)
     cursor = conn.execute(
-        "INSERT INTO notes (title, body, tags, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
-        (note.title, note.body, json.dumps(note.tags), now, now),
+        "INSERT INTO notes (title, body, body_length, tags, created_at, updated_at)"
+        " VALUES (?, ?, ?, ?, ?, ?)",
+        (note.title, preview, len(note.body), json.dumps(note.tags), now, now),
     )
+    write_body(conn, cursor.lastrowid, packed)
+    write_tags(conn, cursor.lastrowid, note.tags)
     conn.commit()
-    row = conn.execute("SELECT * FROM notes WHERE id = ?", (cursor.lastrowid,)).fetchone()
-    conn.close()
+    suggest_index.sync(conn)
+    row = conn.execute(f"{FULL_NOTE_SQL} WHERE notes.id = ?", (cursor.lastrowid,)).fetchone()
     return row_to_note(row)
 
 
 @router.get("", response_model=list[NoteResponse])
-def list_notes():
-    conn = get_connection()
-    rows = conn.execute("SELECT * FROM notes ORDER BY created_at DESC").fetchall()
-    conn.close()
-    return [row_to_note(r) for r in rows]
+def list_notes(
+    request: Request,
+    response: Response,
+    limit: int | None = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = Query(default=None),
+    fields: str | None = Query(default=None),
+    conn: sqlite3.Connection = Depends(get_db),
+):
+    names = parse_fields(fields, NOTE_FIELDS)
+    after = decode_cursor(cursor, "created") if cursor else None
+    not_modified = conditional.check(request, response, conditional.table_version(conn, "notes"))
+    if not_modified:
+        return not_modified
+    if after and limit is None:
+        limit = PAGE_SIZE
+
+    sql = f"SELECT {select_columns(names, 'created_at')} FROM notes"
+    params = []
+    if after:
+        sql += " WHERE (created_at, id) < (?, ?)"
+        params.extend(after)
+    sql += " ORDER BY created_at DESC, id DESC"
+    rows, next_cursor = fetch_page(conn, sql, params, limit, "created", "created_at", "id")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if names is None and fastjson.ENABLED:
+        names = NOTE_FIELDS
+    if names:
+        with stage_duration.time("fast_json"):
+            return fastjson.response([project(r, names) for r in rows], response)
+    with stage_duration.time("row_to_note"):
+        return [row_to_note(r) for r in rows]
 
 
-@router.get("/search", response_model=list[NoteResponse])
+@router.get("/search", response_model=list[NoteSearchResult])
 def search_notes(
-    tag: str | None = Query(default=None),
+    response: Response,
+    tag: list[str] | None = Query(default=None),
+    tag_mode: str = Query(default="all", pattern="^(all|any)$"),
     q: str | None = Query(default=None),
+    snippets: bool = Query(default=False),
+    limit: int | None = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = Query(default=None),
+    fields: str | None = Query(default=None),
+    conn: sqlite3.Connection = Depends(get_db),
 ):
-    conn = get_connection()
+    names = parse_fields(fields, NOTE_FIELDS + ("snippet",))
+    # Text searches page by rank, tag-only searches by creation time like the listing.
+    kind, key = ("rank", ("score", "id")) if q else ("created", ("created_at", "id"))
+    after = decode_cursor(cursor, kind) if cursor else None
+    if after and limit is None:
+        limit = PAGE_SIZE
     clauses = []
     params = []
 
     if tag:
-        clauses.append("tags LIKE ?")
-        params.append(f'%"{tag}"%')
+        # Same filter, same SQL, so equivalent searches share a cache entry.
+        tag = sorted(set(tag))
+        if len(tag) == 1:
+            tag_mode = "all"
+        clause, tag_params = tag_filter(tag, tag_mode)
+        clauses.append(clause)
+        params.extend(tag_params)
+
     if q:
-        clauses.append("(title LIKE ? OR body LIKE ?)")
-        params.extend([f"%{q}%", f"%{q}%"])
+        match = fts_query(q)
+        if match is None:
+            return []
+        clauses.insert(0, "notes_fts MATCH ?")
+        params.insert(0, match)
+        if after:
+            clauses.append(f"({RANK}, notes.id) > (?, ?)")
+            params.extend(after)
+        snippet = SNIPPET if snippets else "NULL"
+        sql = (
+            f"SELECT {select_columns(names)}, {snippet} AS snippet, {RANK} AS score FROM notes_fts"
+            " JOIN notes ON notes.id = notes_fts.rowid"
+            f" WHERE {' AND '.join(clauses)} ORDER BY score, notes.id"
+        )
+    else:
+        if after:
+            clauses.append("(notes.created_at, notes.id) < (?, ?)")
+            params.extend(after)
+        where = " AND ".join(clauses) if clauses else "1=1"
+        sql = (
+            f"SELECT {select_columns(names, 'created_at')}, NULL AS snippet FROM notes"
+            f" WHERE {where} ORDER BY notes.created_at DESC, notes.id DESC"
+        )
+    # The statement and its parameters pin down the result, with q already normalized by fts_query.
+    cache_key = (sql, tuple(params), limit)
+    generation = conditional.table_version(conn, "notes")["version"]
+    page = search_cache.get(cache_key, generation)
+    if page is None:
+        try:
+            page = fetch_page(conn, sql, params, limit, kind, *key)
+        except sqlite3.OperationalError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid search query: {e}")
+        search_cache.set(cache_key, generation, page, rows_size(page[0]))
+    rows, next_cursor = page
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if names is None and fastjson.ENABLED:
+        names = NOTE_FIELDS + ("snippet",)
+    if names:
+        with stage_duration.time("fast_json"):
+            return fastjson.response([project(r, names) for r in rows], response)
+    with stage_duration.time("row_to_note"):
+        return [row_to_search_result(r) for r in rows]
+
+
+@router.get("/tags", response_model=list[TagCount])
+def list_tags(
+    limit: int | None = Query(default=None, ge=1),
+    conn: sqlite3.Connection = Depends(get_db),
+):
+    # Counted from the (tag, note_id) primary key alone; notes is never read.
+    sql = "SELECT tag, COUNT(*) AS count FROM note_tags GROUP BY tag ORDER BY count DESC, tag"
+    params = []
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return [TagCount(tag=row["tag"], count=row["count"]) for row in conn.execute(sql, params)]
+
+
+async def read_lines(request: Request):
+    """Yield (line number, line) from a streamed body without holding all of it."""
+    number = 0
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            number += 1
+            if line.strip():
+                yield number, line
+    if buffer.strip():
+        yield number + 1, buffer
+
+
+def import_chunk(items: list[tuple[int, bytes]]) -> tuple[int, list[ImportLineError]]:
+    errors = []
+    rows = []
+    packed_bodies = []
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    for line, raw in items:
+        try:
+            note = NoteImport.model_validate_json(raw)
+        except ValidationError as e:
+            detail = "; ".join(err["msg"] for err in e.errors())
+            errors.append(ImportLineError(line=line, detail=detail))
+            continue
+        created = note.created_at or now
+        preview, packed = bodies.pack(note.body)
+        rows.append((
+            note.title, preview, len(note.body), json.dumps(note.tags), created,
+            note.updated_at or created,
+        ))
+        packed_bodies.append(packed)
+    if not rows:
+        return 0, errors
+
+    with pool.connection() as conn:
+        # IMMEDIATE keeps other writers out, so this chunk's ids are exactly those above last_id.
+        conn.execute("BEGIN IMMEDIATE")
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM notes").fetchone()[0]
+        conn.executemany(
+            "INSERT INTO notes (title, body, body_length, tags, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        if any(packed is not None for packed in packed_bodies):
+            ids = conn.execute("SELECT id FROM notes WHERE id > ? ORDER BY id", (last_id,)).fetchall()
+            conn.executemany(
+                "INSERT INTO note_bodies (note_id, body) VALUES (?, ?)",
+                [(row["id"], packed) for row, packed in zip(ids, packed_bodies) if packed is not None],
+            )
+        conn.execute(
+            "INSERT OR IGNORE INTO note_tags (tag, note_id)"
+            " SELECT json_each.value, notes.id FROM notes, json_each(notes.tags) WHERE notes.id > ?",
+            (last_id,),
+        )
+        conn.commit()
+    return len(rows), errors
+
+
+@router.post(
+    "/import",
+    response_model=ImportResult,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/x-ndjson": {"schema": NoteImport.model_json_schema()}},
+        }
+    },
+)
+async def import_notes(request: Request):
+    imported = 0
+    errors = []
+    chunk = []
+    async for line, raw in read_lines(request):
+        chunk.append((line, raw))
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            count, chunk_errors = await run_in_threadpool(import_chunk, chunk)
+            imported += count
+            errors.extend(chunk_errors)
+            chunk = []
+    if chunk:
+        count, chunk_errors = await run_in_threadpool(import_chunk, chunk)
+        imported += count
+        errors.extend(chunk_errors)
+    await run_in_threadpool(suggest_index.sync)
+    return ImportResult(imported=imported, errors=errors)
+
 
-    where = " AND ".join(clauses) if clauses else "1=1"
+def export_lines():
+    with pool.connection() as conn:
+        cursor = conn.execute(f"{FULL_NOTE_SQL} ORDER BY notes.id")
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            yield "".join(
+                json.dumps({
+                    "id": r["id"],
+                    "title": r["title"],
+                    "body": r["body"],
+                    "tags": json.loads(r["tags"]),
+                    "created_at": r["created_at"],
+                    "updated_at": r["updated_at"],
+                }) + "\n"
+                for r in rows
+            )
+
+
+@router.get("/export")
+def export_notes():
+    return StreamingResponse(
+        export_lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=notes.ndjson"},
+    )
+
+
+@router.get("/suggest", response_model=list[Suggestion])
+async def suggest_notes(
+    prefix: str = Query(min_length=1, max_length=200),
+    kind: str = Query(default="title", pattern="^(title|tag)$"),
+    limit: int = Query(default=10, ge=1, le=100),
+):
+    # Served from memory on the event loop; SQLite isn't touched.
+    return [Suggestion(text=text, count=count) for text, count in suggest_index.lookup(kind, prefix, limit)]
+
+
+@router.get("/changes", response_model=NoteChanges)
+def list_changes(
+    since: str | None = Query(default=None),
+    limit: int = Query(default=PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    conn: sqlite3.Connection = Depends(get_db),
+):
+    """Notes written and deleted after since, oldest change first.
+
+    Without since, every note is returned. Pass the returned token as since next
+    time; while has_more is true there are further changes to fetch straight away.
+    """
+    if since:
+        after = deleted_after = decode_cursor(since, "changes", size=1)[0]
+    else:
+        # A first sync has nothing to delete, so skip the tombstones written so far.
+        after = 0
+        deleted_after = conn.execute(
+            "SELECT value FROM sequences WHERE name = 'note_changes'"
+        ).fetchone()["value"]
+    # One statement, so notes and tombstones come from the same snapshot.
     rows = conn.execute(
-        f"SELECT * FROM notes WHERE {where} ORDER BY created_at DESC", params
+        CHANGES_SQL, (after, limit + 1, deleted_after, limit + 1, limit + 1)
     ).fetchall()
-    conn.close()
-    return [row_to_note(r) for r in rows]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        after = rows[-1]["change_seq"]
+    if not has_more:
+        after = max(after, deleted_after)
+    return NoteChanges(
+        notes=[row_to_note(r) for r in rows if not r["deleted"]],
+        deleted=[r["id"] for r in rows if r["deleted"]],
+        token=encode_cursor("changes", after),
+        has_more=has_more,
+    )
 
 
 @router.get("/{note_id}", response_model=NoteResponse)
-def get_note(note_id: int):
-    conn = get_connection()
-    row = conn.execute("SELECT * FROM notes WHERE id = ?", (note_id,)).fetchone()
-    conn.close()
+def get_note(
+    note_id: int, request: Request, response: Response, conn: sqlite3.Connection = Depends(get_db)
+):
+    version = conditional.table_version(conn, "notes")
+    row = conn.execute(f"{FULL_NOTE_SQL} WHERE notes.id = ?", (note_id,)).fetchone()
     if not row:
         raise HTTPException(status_code=404, detail="Note not found")
+    not_modified = conditional.check(request, response, version, note_id)
+    if not_modified:
+        return not_modified
     return row_to_note(row)
 
 
 @router.put("/{note_id}", response_model=NoteResponse)
-def update_note(note_id: int, updates: NoteUpdate):
-    conn = get_connection()
-    row = conn.execute("SELECT * FROM notes WHERE id = ?", (note_id,)).fetchone()
+def update_note(note_id: int, updates: NoteUpdate, conn: sqlite3.Connection = Depends(get_db)):
+    row = conn.execute("SELECT id FROM notes WHERE id = ?", (note_id,)).fetchone()
     if not row:
-        conn.close()
         raise HTTPException(status_code=404, detail="Note not found")
 
     fields = {}
+    packed = None
     if updates.title is not None:
         fields["title"] = updates.title
     if updates.body is not None:
-        fields["body"] = updates.body
+        fields["body"], packed = bodies.pack(updates.body)
+        fields["body_length"] = len(updates.body)
     if updates.tags is not None:
         fields["tags"] = json.dumps(updates.tags)
 
     if not fields:
-        conn.close()
         raise HTTPException(status_code=400, detail="No fields to update")
 
     fields["updated_at"] = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
@@ -102,19 +515,22 @@ def update_note(note_id: int, updates: NoteUpdate):
     values = list(fields.values()) + [note_id]
 
     conn.execute(f"UPDATE notes SET {set_clause} WHERE id = ?", values)
+    if updates.body is not None:
+        write_body(conn, note_id, packed, replace=True)
+    if updates.tags is not None:
+        write_tags(conn, note_id, updates.tags, replace=True)
     conn.commit()
-    row = conn.execute("SELECT * FROM notes WHERE id = ?", (note_id,)).fetchone()
-    conn.close()
+    suggest_index.sync(conn)
+    row = conn.execute(f"{FULL_NOTE_SQL} WHERE notes.id = ?", (note_id,)).fetchone()
     return row_to_note(row)
 
 
 @router.delete("/{note_id}", status_code=204)
-def delete_note(note_id: int):
-    conn = get_connection()
-    row = conn.execute("SELECT * FROM notes WHERE id = ?", (note_id,)).fetchone()
+def delete_note(note_id: int, conn: sqlite3.Connection = Depends(get_db)):
+    row = conn.execute("SELECT id FROM notes WHERE id = ?", (note_id,)).fetchone()
     if not row:
-        conn.close()
         raise HTTPException(status_code=404, detail="Note not found")
+    conn.execute("DELETE FROM note_tags WHERE note_id = ?", (note_id,))
     conn.execute("DELETE FROM notes WHERE id = ?", (note_id,))
     conn.commit()
-    conn.close()
+    suggest_index.sync(conn)
@@ -0,0 +1,96 @@
+import os
+import threading
+from collections import OrderedDict
+
+CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1000"))
+CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+ROW_OVERHEAD = 64
+
+
+def rows_size(rows) -> int:
+    """Rough memory held by a list of sqlite3.Row: string bytes plus a flat per-value cost."""
+    size = 0
+    for row in rows:
+        size += ROW_OVERHEAD
+        for value in row:
+            size += len(value) if isinstance(value, (str, bytes)) else 8
+    return size
+
+
+class SearchCache:
+    """LRU of search results, each tagged with the notes generation it was read at.
+
+    The generation is the notes row of table_versions, which triggers bump on every
+    write from any worker. A lookup at a newer generation is a miss, so invalidating
+    everything costs nothing and stale entries are dropped when they're next seen
+    or pushed out by the size and memory limits.
+    """
+
+    def __init__(self, maxsize: int, max_bytes: int):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, generation: int):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry_generation, value, size = entry
+            if entry_generation != generation:
+                del self._data[key]
+                self.bytes -= size
+                self.stale += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, generation: int, value, size: int):
+        if self.maxsize <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._data[key] = (generation, value, size)
+            self.bytes += size
+            while len(self._data) > self.maxsize or self.bytes > self.max_bytes:
+                _, (_, _, evicted) = self._data.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.stale = 0
+            self.evictions = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+search_cache = SearchCache(CACHE_SIZE, CACHE_MAX_BYTES)
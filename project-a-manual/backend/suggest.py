@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import threading
+from bisect import bisect_left, insort
+from collections import Counter
+
+from database import pool
+
+SYNC_INTERVAL = float(os.getenv("SUGGEST_SYNC_INTERVAL", "1.0"))
+
+# Same snapshot for both halves, so nothing between the two reads is missed.
+CHANGES_SQL = (
+    "SELECT id, title, tags, change_seq FROM notes WHERE change_seq > ?"
+    " UNION ALL"
+    " SELECT note_id, NULL, NULL, change_seq FROM note_tombstones WHERE change_seq > ?"
+)
+
+logger = logging.getLogger(__name__)
+
+
+class PrefixIndex:
+    """Distinct strings kept sorted by casefolded form, with how many notes use each."""
+
+    def __init__(self, texts=()):
+        self._counts = dict(Counter(texts))
+        self._keys = sorted((text.casefold(), text) for text in self._counts)
+
+    def add(self, text: str):
+        count = self._counts.get(text, 0)
+        if not count:
+            insort(self._keys, (text.casefold(), text))
+        self._counts[text] = count + 1
+
+    def remove(self, text: str):
+        count = self._counts.get(text, 0)
+        if count > 1:
+            self._counts[text] = count - 1
+        elif count:
+            del self._counts[text]
+            key = (text.casefold(), text)
+            del self._keys[bisect_left(self._keys, key)]
+
+    def lookup(self, prefix: str, limit: int) -> list[tuple[str, int]]:
+        prefix = prefix.casefold()
+        keys = self._keys
+        results = []
+        for i in range(bisect_left(keys, (prefix,)), len(keys)):
+            folded, text = keys[i]
+            if not folded.startswith(prefix) or len(results) >= limit:
+                break
+            results.append((text, self._counts[text]))
+        return results
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class SuggestIndex:
+    """In-memory title and tag prefix indexes, so suggestions never query SQLite.
+
+    Built from notes at startup, then kept current by tailing the change feed
+    (notes.change_seq and note_tombstones): the write routes call sync() right
+    after committing, and a background thread picks up writes from other workers
+    every SYNC_INTERVAL seconds. Until the first build finishes there are no
+    suggestions.
+    """
+
+    def __init__(self):
+        self.titles = PrefixIndex()
+        self.tags = PrefixIndex()
+        self.ready = False
+        self._notes = {}
+        self._last_seq = 0
+        self._lock = threading.Lock()
+        # Serializes rebuilds and syncs so changes are applied in order; lookups only wait on _lock.
+        self._sync_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def lookup(self, kind: str, prefix: str, limit: int) -> list[tuple[str, int]]:
+        index = self.titles if kind == "title" else self.tags
+        with self._lock:
+            return index.lookup(prefix, limit)
+
+    def _forget(self, note_id: int):
+        old = self._notes.pop(note_id, None)
+        if old is not None:
+            self.titles.remove(old[0])
+            for tag in old[1]:
+                self.tags.remove(tag)
+
+    def _apply(self, note_id: int, title: str | None, tags: str | None):
+        self._forget(note_id)
+        if title is None:
+            return
+        note_tags = tuple(dict.fromkeys(json.loads(tags)))
+        self._notes[note_id] = (title, note_tags)
+        self.titles.add(title)
+        for tag in note_tags:
+            self.tags.add(tag)
+
+    def rebuild(self):
+        with self._sync_lock:
+            with pool.connection() as conn:
+                last_seq = conn.execute(
+                    "SELECT value FROM sequences WHERE name = 'note_changes'"
+                ).fetchone()["value"]
+                rows = conn.execute("SELECT id, title, tags FROM notes").fetchall()
+            notes = {row["id"]: (row["title"], tuple(dict.fromkeys(json.loads(row["tags"])))) for row in rows}
+            # Sorted once here; insort is only for incremental changes.
+            titles = PrefixIndex(title for title, _ in notes.values())
+            tags = PrefixIndex(tag for _, note_tags in notes.values() for tag in note_tags)
+            with self._lock:
+                self.titles, self.tags, self._notes = titles, tags, notes
+                self._last_seq = last_seq
+                self.ready = True
+
+    def sync(self, conn=None):
+        if not self.ready:
+            return
+        if conn is None:
+            with pool.connection() as conn:
+                self.sync(conn)
+            return
+        with self._sync_lock:
+            rows = conn.execute(CHANGES_SQL, (self._last_seq, self._last_seq)).fetchall()
+            if not rows:
+                return
+            with self._lock:
+                for row in rows:
+                    self._apply(row["id"], row["title"], row["tags"])
+                self._last_seq = max(row["change_seq"] for row in rows)
+
+    def reset(self):
+        with self._lock:
+            self.titles = PrefixIndex()
+            self.tags = PrefixIndex()
+            self._notes = {}
+            self._last_seq = 0
+            self.ready = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"notes": len(self._notes), "titles": len(self.titles), "tags": len(self.tags)}
+
+    def _run(self):
+        while not self._stopping.wait(SYNC_INTERVAL):
+            try:
+                self.sync()
+            except Exception:
+                logger.exception("suggest index sync failed")
+
+    def start(self):
+        self.rebuild()
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="suggest-sync", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+
+suggest_index = SuggestIndex()
@@ -1,4 +1,8 @@
+import json
+from datetime import datetime, timezone
+from email.utils import format_datetime
 import sys
+import time
 import os
 import pytest
 from fastapi.testclient import TestClient
@@ -6,7 +10,14 @@ from fastapi.testclient import TestClient
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
 
 from main import app
-from database import DB_PATH, init_db, get_connection
+from admission import admission
+import bodies
+import fastjson
+import database
+from metrics import query_duration
+from database import DB_PATH, init_db, get_connection, pool
+from search_cache import SearchCache, search_cache
+from suggest import suggest_index
 
 client = TestClient(app)
 HEADERS = {"X-API-Key": "dev-api-key"}
@@ -82,6 +93,29 @@ def test_search_by_tag():
     assert any(n["title"] == "Tagged" for n in r.json())
 
 
+def test_search_by_multiple_tags():
+    client.post("/api/notes", json={"title": "Both", "tags": ["work", "urgent"]}, headers=HEADERS)
+    client.post("/api/notes", json={"title": "Work only", "tags": ["work"]}, headers=HEADERS)
+    client.post("/api/notes", json={"title": "Home", "tags": ["home"]}, headers=HEADERS)
+    r = client.get("/api/notes/search?tag=work&tag=urgent", headers=HEADERS)
+    assert [n["title"] for n in r.json()] == ["Both"]
+    r = client.get("/api/notes/search?tag=urgent&tag=home&tag_mode=any", headers=HEADERS)
+    assert sorted(n["title"] for n in r.json()) == ["Both", "Home"]
+    assert r.json()[0]["tags"] in (["work", "urgent"], ["home"])
+
+
+def test_tag_facets_follow_writes():
+    a = client.post("/api/notes", json={"title": "A", "tags": ["x", "y"]}, headers=HEADERS).json()
+    client.post("/api/notes", json={"title": "B", "tags": ["x"]}, headers=HEADERS)
+    r = client.get("/api/notes/tags", headers=HEADERS)
+    assert r.json() == [{"tag": "x", "count": 2}, {"tag": "y", "count": 1}]
+    client.put(f"/api/notes/{a['id']}", json={"tags": ["z"]}, headers=HEADERS)
+    assert client.get("/api/notes/search?tag=y", headers=HEADERS).json() == []
+    client.delete(f"/api/notes/{a['id']}", headers=HEADERS)
+    r = client.get("/api/notes/tags?limit=5", headers=HEADERS)
+    assert r.json() == [{"tag": "x", "count": 1}]
+
+
 def test_search_by_keyword():
     client.post("/api/notes", json={"title": "Unique needle"}, headers=HEADERS)
     r = client.get("/api/notes/search?q=needle", headers=HEADERS)
@@ -89,6 +123,276 @@ def test_search_by_keyword():
     assert any("needle" in n["title"] for n in r.json())
 
 
+def test_search_ranks_title_matches_first():
+    client.post("/api/notes", json={"title": "Groceries", "body": "buy a python book"}, headers=HEADERS)
+    client.post("/api/notes", json={"title": "Python tips", "body": "use generators"}, headers=HEADERS)
+    client.post("/api/notes", json={"title": "Unrelated", "body": "nothing here"}, headers=HEADERS)
+    r = client.get("/api/notes/search?q=python", headers=HEADERS)
+    assert [n["title"] for n in r.json()] == ["Python tips", "Groceries"]
+    assert r.json()[0]["snippet"] is None
+
+
+def test_search_prefix_phrase_and_snippets():
+    client.post(
+        "/api/notes",
+        json={"title": "Fox", "body": "the quick brown fox jumps over the lazy dog"},
+        headers=HEADERS,
+    )
+    client.post("/api/notes", json={"title": "Brown", "body": "quick but not brown"}, headers=HEADERS)
+    r = client.get('/api/notes/search?q="quick brown"', headers=HEADERS)
+    assert [n["title"] for n in r.json()] == ["Fox"]
+    r = client.get("/api/notes/search?q=jum*&snippets=true", headers=HEADERS)
+    assert [n["title"] for n in r.json()] == ["Fox"]
+    assert "<mark>jumps</mark>" in r.json()[0]["snippet"]
+    assert client.get("/api/notes/search?q=jum", headers=HEADERS).json() == []
+    assert client.get("/api/notes/search?q=NEAR(fox", headers=HEADERS).status_code == 200
+
+
+def test_search_index_follows_updates_and_deletes():
+    note = client.post("/api/notes", json={"title": "Old words"}, headers=HEADERS).json()
+    client.put(f"/api/notes/{note['id']}", json={"title": "Fresh words"}, headers=HEADERS)
+    assert client.get("/api/notes/search?q=old", headers=HEADERS).json() == []
+    assert len(client.get("/api/notes/search?q=fresh", headers=HEADERS).json()) == 1
+    client.delete(f"/api/notes/{note['id']}", headers=HEADERS)
+    assert client.get("/api/notes/search?q=fresh", headers=HEADERS).json() == []
+
+
+def collect_pages(url):
+    pages = []
+    while True:
+        r = client.get(url, headers=HEADERS)
+        assert r.status_code == 200
+        pages.append(r.json())
+        cursor = r.headers.get("x-next-cursor")
+        if not cursor:
+            return pages
+        url = url.split("&cursor=")[0] + f"&cursor={cursor}"
+
+
+def test_list_notes_pages_with_cursor():
+    ids = [
+        client.post("/api/notes", json={"title": f"Page {i}"}, headers=HEADERS).json()["id"]
+        for i in range(5)
+    ]
+    pages = collect_pages("/api/notes?limit=2")
+    assert [len(page) for page in pages] == [2, 2, 1]
+    # Notes created within the same second still come back once each, newest first.
+    assert [n["id"] for page in pages for n in page] == ids[::-1]
+    assert client.get("/api/notes?cursor=bogus", headers=HEADERS).status_code == 400
+
+
+def test_fields_projection():
+    client.post("/api/notes", json={"title": "Slim", "body": "x" * 1000, "tags": ["t"]}, headers=HEADERS)
+    r = client.get("/api/notes?fields=title,tags", headers=HEADERS)
+    assert r.status_code == 200
+    assert r.json() == [{"title": "Slim", "tags": ["t"]}]
+    assert "etag" in r.headers
+    r = client.get("/api/notes/search?q=slim&fields=id,snippet&snippets=true", headers=HEADERS)
+    assert set(r.json()[0]) == {"id", "snippet"}
+    assert client.get("/api/notes?fields=title,secret", headers=HEADERS).status_code == 400
+
+
+def test_search_pages_by_rank_and_by_date():
+    for i in range(3):
+        client.post("/api/notes", json={"title": f"Paged {i}", "tags": ["p"]}, headers=HEADERS)
+    client.post("/api/notes", json={"title": "Paged paged", "tags": ["p"]}, headers=HEADERS)
+    ranked = client.get("/api/notes/search?q=paged", headers=HEADERS).json()
+    pages = collect_pages("/api/notes/search?q=paged&limit=3")
+    assert [n["id"] for page in pages for n in page] == [n["id"] for n in ranked]
+    assert [len(page) for page in pages] == [3, 1]
+    pages = collect_pages("/api/notes/search?tag=p&limit=3")
+    assert sum(len(page) for page in pages) == 4
+    # A rank cursor doesn't fit a tag-only search.
+    r = client.get("/api/notes/search?q=paged&limit=1", headers=HEADERS)
+    cursor = r.headers["x-next-cursor"]
+    assert client.get(f"/api/notes/search?tag=p&cursor={cursor}", headers=HEADERS).status_code == 400
+
+
+def test_fast_json_matches_model_path(monkeypatch):
+    client.post("/api/notes", json={"title": "Fast é", "body": "quick", "tags": ["x", "ü"]}, headers=HEADERS)
+    client.post("/api/notes", json={"title": "Other quick"}, headers=HEADERS)
+    urls = ["/api/notes", "/api/notes/search?q=quick&snippets=true", "/api/notes/search?tag=x"]
+    slow = [client.get(url, headers=HEADERS) for url in urls]
+    monkeypatch.setattr(fastjson, "ENABLED", True)
+    fast = [client.get(url, headers=HEADERS) for url in urls]
+    for before, after in zip(slow, fast):
+        assert after.json() == before.json()
+        assert after.headers["content-type"] == "application/json"
+    assert fast[0].headers["etag"] == slow[0].headers["etag"]
+
+
+def test_import_and_export_ndjson():
+    lines = [
+        '{"title": "Imported", "body": "b", "tags": ["old", "x"], "created_at": "2020-01-02 03:04:05"}',
+        "",
+        "not json",
+        '{"title": ""}',
+        '{"title": "Second"}',
+    ]
+    r = client.post(
+        "/api/notes/import",
+        content="\n".join(lines).encode(),
+        headers={**HEADERS, "Content-Type": "application/x-ndjson"},
+    )
+    assert r.status_code == 200
+    result = r.json()
+    assert result["imported"] == 2
+    assert [e["line"] for e in result["errors"]] == [3, 4]
+    assert [n["title"] for n in client.get("/api/notes/search?tag=old", headers=HEADERS).json()] == ["Imported"]
+    assert len(client.get("/api/notes/search?q=imported", headers=HEADERS).json()) == 1
+
+    r = client.get("/api/notes/export", headers=HEADERS)
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    exported = [json.loads(line) for line in r.text.splitlines()]
+    assert [n["title"] for n in exported] == ["Imported", "Second"]
+    assert exported[0]["tags"] == ["old", "x"]
+    assert exported[0]["created_at"] == exported[0]["updated_at"] == "2020-01-02 03:04:05"
+
+
+def fts_intact():
+    conn = get_connection()
+    try:
+        conn.execute("INSERT INTO notes_fts (notes_fts, rank) VALUES ('integrity-check', 1)")
+    finally:
+        conn.close()
+
+
+def test_large_bodies_compressed_and_loaded_lazily():
+    body = "lorem ipsum " * 2000 + "zebra"
+    note = client.post("/api/notes", json={"title": "Big", "body": body}, headers=HEADERS).json()
+    assert note["body"] == body
+    assert note["body_length"] == len(body)
+    listed = client.get("/api/notes", headers=HEADERS).json()[0]
+    assert listed["body"] == body[:bodies.PREVIEW_CHARS]
+    assert listed["body_length"] == len(body)
+    assert client.get(f"/api/notes/{note['id']}", headers=HEADERS).json()["body"] == body
+    conn = get_connection()
+    stored = conn.execute("SELECT body FROM note_bodies WHERE note_id = ?", (note["id"],)).fetchone()
+    conn.close()
+    assert len(stored["body"]) < len(body) // 10
+
+    # The index has the whole body, not just the preview.
+    r = client.get("/api/notes/search?q=zebra&snippets=true", headers=HEADERS).json()
+    assert [n["id"] for n in r] == [note["id"]]
+    assert "<mark>zebra</mark>" in r[0]["snippet"]
+    fts_intact()
+
+    client.put(f"/api/notes/{note['id']}", json={"title": "Bigger", "body": body + " yak"}, headers=HEADERS)
+    assert len(client.get("/api/notes/search?q=yak", headers=HEADERS).json()) == 1
+    client.put(f"/api/notes/{note['id']}", json={"body": "short now"}, headers=HEADERS)
+    assert client.get("/api/notes/search?q=zebra", headers=HEADERS).json() == []
+    assert client.get(f"/api/notes/{note['id']}", headers=HEADERS).json()["body"] == "short now"
+    fts_intact()
+
+    client.put(f"/api/notes/{note['id']}", json={"body": body}, headers=HEADERS)
+    exported = client.get("/api/notes/export", headers=HEADERS).text
+    assert json.loads(exported)["body"] == body
+    client.delete(f"/api/notes/{note['id']}", headers=HEADERS)
+    assert client.get("/api/notes/search?q=zebra", headers=HEADERS).json() == []
+    fts_intact()
+
+
+def test_search_cache_hits_and_invalidates():
+    search_cache.clear()
+    client.post("/api/notes", json={"title": "Cached search", "tags": ["a", "b"]}, headers=HEADERS)
+    first = client.get("/api/notes/search?q=cached&tag=a&tag=b", headers=HEADERS).json()
+    again = client.get("/api/notes/search?q=cached&tag=b&tag=a&tag=a", headers=HEADERS).json()
+    assert again == first
+    assert search_cache.stats()["hits"] == 1
+
+    # A write through another connection (another worker) still invalidates.
+    conn = get_connection()
+    conn.execute("INSERT INTO notes (title, tags) VALUES ('Cached too', '[\"a\", \"b\"]')")
+    conn.execute("INSERT INTO note_tags (tag, note_id) SELECT value, last_insert_rowid() FROM json_each('[\"a\", \"b\"]')")
+    conn.commit()
+    conn.close()
+    r = client.get("/api/notes/search?q=cached&tag=a&tag=b", headers=HEADERS).json()
+    assert len(r) == 2
+    stats = search_cache.stats()
+    assert stats["stale"] == 1 and stats["hits"] == 1
+    assert 0 < stats["hit_ratio"] < 1
+
+    r = client.get("/metrics")
+    assert "search_cache_hits_total 1" in r.text
+
+
+def test_search_cache_evicts_by_count_and_bytes():
+    cache = SearchCache(maxsize=2, max_bytes=100)
+    cache.set("a", 1, "A", 10)
+    cache.set("b", 1, "B", 10)
+    cache.set("c", 1, "C", 10)
+    assert cache.get("a", 1) is None and cache.get("c", 1) == "C"
+    cache.set("d", 1, "D", 85)
+    assert cache.stats()["bytes"] <= 100
+    assert cache.get("b", 1) is None and cache.get("c", 1) == "C" and cache.get("d", 1) == "D"
+    cache.set("huge", 1, "H", 500)
+    assert cache.get("huge", 1) is None
+    # An entry from an older generation is never returned.
+    assert cache.get("d", 2) is None and cache.stats()["size"] == 1
+    assert cache.stats()["evictions"] == 2
+
+
+def test_changes_feed_with_tombstones():
+    token = client.get("/api/notes/changes", headers=HEADERS).json()["token"]
+    a = client.post("/api/notes", json={"title": "A"}, headers=HEADERS).json()
+    b = client.post("/api/notes", json={"title": "B"}, headers=HEADERS).json()
+    r = client.get(f"/api/notes/changes?since={token}", headers=HEADERS).json()
+    assert [n["title"] for n in r["notes"]] == ["A", "B"]
+    assert r["deleted"] == [] and not r["has_more"]
+    token = r["token"]
+
+    client.put(f"/api/notes/{a['id']}", json={"title": "A2"}, headers=HEADERS)
+    client.delete(f"/api/notes/{b['id']}", headers=HEADERS)
+    c = client.post("/api/notes", json={"title": "C"}, headers=HEADERS).json()
+    r = client.get(f"/api/notes/changes?since={token}&limit=2", headers=HEADERS).json()
+    assert [n["title"] for n in r["notes"]] == ["A2"]
+    assert r["deleted"] == [b["id"]] and r["has_more"]
+    r = client.get(f"/api/notes/changes?since={r['token']}&limit=2", headers=HEADERS).json()
+    assert [n["id"] for n in r["notes"]] == [c["id"]]
+    assert not r["has_more"]
+    unchanged = client.get(f"/api/notes/changes?since={r['token']}", headers=HEADERS).json()
+    assert unchanged == {"notes": [], "deleted": [], "token": r["token"], "has_more": False}
+
+    full = client.get("/api/notes/changes?limit=1000", headers=HEADERS).json()
+    assert {n["id"] for n in full["notes"]} == {a["id"], c["id"]}
+    assert full["deleted"] == []
+    assert client.get("/api/notes/changes?since=bogus", headers=HEADERS).status_code == 400
+
+
+def test_suggestions_follow_writes(monkeypatch):
+    suggest_index.rebuild()
+    def suggest(prefix, kind="title", limit=10):
+        r = client.get(f"/api/notes/suggest?prefix={prefix}&kind={kind}&limit={limit}", headers=HEADERS)
+        assert r.status_code == 200
+        return [(s["text"], s["count"]) for s in r.json()]
+
+    a = client.post("/api/notes", json={"title": "Zebra crossing", "tags": ["zoo", "Zoology"]}, headers=HEADERS).json()
+    client.post("/api/notes", json={"title": "zebra finch", "tags": ["zoo"]}, headers=HEADERS)
+    client.post("/api/notes", json={"title": "Zebra crossing", "tags": []}, headers=HEADERS)
+    assert suggest("zEB") == [("Zebra crossing", 2), ("zebra finch", 1)]
+    assert suggest("zebra", limit=1) == [("Zebra crossing", 2)]
+    assert suggest("zo", kind="tag") == [("zoo", 2), ("Zoology", 1)]
+
+    client.put(f"/api/notes/{a['id']}", json={"title": "Zebu", "tags": ["zoo"]}, headers=HEADERS)
+    assert suggest("zeb") == [("Zebra crossing", 1), ("zebra finch", 1), ("Zebu", 1)]
+    assert suggest("zoo", kind="tag") == [("zoo", 2)]
+    client.delete(f"/api/notes/{a['id']}", headers=HEADERS)
+    assert suggest("zebu") == []
+
+    # Writes from elsewhere (another worker, a script) show up on the next sync.
+    with pool.connection() as conn:
+        conn.execute("""INSERT INTO notes (title, tags) VALUES ('Zeppelin', '["zoo"]')""")
+        conn.commit()
+    assert suggest("zep") == []
+    suggest_index.sync()
+    assert suggest("zep") == [("Zeppelin", 1)]
+
+    # Lookups are answered from memory without a connection.
+    monkeypatch.setattr(pool, "connection", None)
+    assert suggest("zoo", kind="tag") == [("zoo", 2)]
+    assert client.get("/api/notes/suggest?prefix=z&kind=body", headers=HEADERS).status_code == 422
+
+
 def test_auth_rejected():
     r = client.get("/api/notes", headers={"X-API-Key": "wrong"})
     assert r.status_code == 401
@@ -102,3 +406,123 @@ def test_auth_missing():
 def test_validation_empty_title():
     r = client.post("/api/notes", json={"title": ""}, headers=HEADERS)
     assert r.status_code == 422
+
+
+def test_connections_reused_from_pool():
+    before = pool.stats()
+    for i in range(5):
+        client.post("/api/notes", json={"title": f"Pooled {i}"}, headers=HEADERS)
+    after = pool.stats()
+    assert after["acquired"] - before["acquired"] == 5
+    assert after["open"] <= max(before["open"], 1)
+
+
+def test_migrations_upgrade_existing_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "old.db"))
+    conn = get_connection()
+    conn.execute(database.MIGRATIONS[0][0])
+    conn.execute("INSERT INTO notes (title) VALUES ('legacy')")
+    conn.execute("""INSERT INTO notes (title, tags) VALUES ('tagged', '["old", "older"]')""")
+    conn.execute("INSERT INTO notes (title, body) VALUES ('long', ?)", ("walrus " * 5000,))
+    conn.commit()
+    conn.close()
+    init_db()
+    init_db()
+    conn = get_connection()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(database.MIGRATIONS)
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM notes ORDER BY created_at DESC").fetchall()
+    assert any("idx_notes_created_at" in r["detail"] for r in plan)
+    assert conn.execute("SELECT title FROM notes").fetchone()["title"] == "legacy"
+    # Notes written before the search index existed are backfilled into it.
+    assert conn.execute("SELECT rowid FROM notes_fts WHERE notes_fts MATCH 'legacy'").fetchone()
+    tags = conn.execute("SELECT tag FROM note_tags ORDER BY tag").fetchall()
+    assert [row["tag"] for row in tags] == ["old", "older"]
+    # Long bodies written before compression existed get compressed and stay searchable.
+    row = conn.execute("SELECT body, body_length FROM notes WHERE title = 'long'").fetchone()
+    assert row["body_length"] == len("walrus " * 5000) and len(row["body"]) == bodies.PREVIEW_CHARS
+    assert conn.execute("SELECT count(*) FROM note_bodies").fetchone()[0] == 1
+    assert conn.execute("SELECT rowid FROM notes_fts WHERE notes_fts MATCH 'walrus'").fetchone()
+    conn.execute("INSERT INTO notes_fts (notes_fts, rank) VALUES ('integrity-check', 1)")
+    seqs = conn.execute("SELECT change_seq FROM notes ORDER BY change_seq").fetchall()
+    assert [row["change_seq"] for row in seqs] == [1, 2, 3]
+    conn.close()
+
+
+def test_metrics_endpoint():
+    client.post("/api/notes", json={"title": "Metered"}, headers=HEADERS)
+    client.get("/api/notes", headers=HEADERS)
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    body = r.text
+    assert 'http_request_duration_seconds_count{method="POST",handler="create_note",status="201"}' in body
+    assert 'sqlite_query_duration_seconds_count{statement="insert notes"}' in body
+    assert 'app_stage_duration_seconds_count{stage="row_to_note"}' in body
+    assert "db_pool_acquired_total" in body
+    assert 'app_stage_duration_seconds_count{stage="serialize"}' in body
+    assert 'app_stage_duration_seconds_count{stage="connection_open"}' in body
+
+
+def test_query_time_includes_fetching():
+    conn = get_connection()
+    conn.create_function("nap", 1, lambda value: time.sleep(0.01) or value)
+    label = ("select json_each",)
+    before = query_duration._series.get(label, [None, 0.0, 0])[1:]
+    # Rows are computed while they're fetched, so most of the time is spent in fetchall().
+    rows = conn.execute("SELECT nap(value) FROM json_each('[1, 2, 3, 4, 5]')").fetchall()
+    assert len(rows) == 5
+    for row in conn.execute("SELECT nap(value) FROM json_each('[1, 2]')"):
+        pass
+    conn.close()
+    total, count = query_duration._series[label][1:]
+    assert count - before[1] == 2
+    assert total - before[0] >= 0.07
+
+
+def test_conditional_get_notes():
+    note = client.post("/api/notes", json={"title": "Cached"}, headers=HEADERS).json()
+    r = client.get("/api/notes", headers=HEADERS)
+    etag = r.headers["etag"]
+    assert client.get("/api/notes", headers={**HEADERS, "If-None-Match": etag}).status_code == 304
+    # Written this second: a second write could still land within the same Last-Modified.
+    assert "last-modified" not in r.headers
+    now = format_datetime(datetime.now(timezone.utc), usegmt=True)
+    assert client.get("/api/notes", headers={**HEADERS, "If-Modified-Since": now}).status_code == 200
+    with pool.connection() as conn:
+        conn.execute("UPDATE table_versions SET updated_at = datetime('now', '-5 seconds') WHERE name = 'notes'")
+        conn.commit()
+    r = client.get("/api/notes", headers=HEADERS)
+    r = client.get(
+        "/api/notes", headers={**HEADERS, "If-Modified-Since": r.headers["last-modified"]}
+    )
+    assert r.status_code == 304
+
+    detail = client.get(f"/api/notes/{note['id']}", headers=HEADERS)
+    assert detail.headers["etag"] != etag
+    r = client.get(
+        f"/api/notes/{note['id']}", headers={**HEADERS, "If-None-Match": detail.headers["etag"]}
+    )
+    assert r.status_code == 304
+
+    client.put(f"/api/notes/{note['id']}", json={"title": "Changed"}, headers=HEADERS)
+    r = client.get(
+        f"/api/notes/{note['id']}", headers={**HEADERS, "If-None-Match": detail.headers["etag"]}
+    )
+    assert r.status_code == 200
+    assert r.json()["title"] == "Changed"
+    assert client.get("/api/notes", headers={**HEADERS, "If-None-Match": etag}).status_code == 200
+
+    # A missing note is a 404 whatever the precondition says.
+    assert client.get("/api/notes/999999", headers={**HEADERS, "If-None-Match": "*"}).status_code == 404
+    r = client.get("/api/notes/999999", headers={**HEADERS, "If-None-Match": detail.headers["etag"]})
+    assert r.status_code == 404
+
+
+def test_writes_shed_when_queue_is_full(monkeypatch):
+    note = client.post("/api/notes", json={"title": "Busy"}, headers=HEADERS).json()
+    write = admission.limiters["write"]
+    monkeypatch.setattr(write, "concurrency", 0)
+    monkeypatch.setattr(write, "queue_size", 0)
+    r = client.put(f"/api/notes/{note['id']}", json={"title": "Later"}, headers=HEADERS)
+    assert r.status_code == 503
+    assert r.headers["retry-after"] == "1"
+    assert client.get(f"/api/notes/{note['id']}", headers=HEADERS).json()["title"] == "Busy"
@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from collections import Counter
+
+HOUR = 3600
+DAY = 86400
+
+HOURLY_RETENTION_DAYS = int(os.getenv("CLICK_HOURLY_RETENTION_DAYS", "14"))
+DAILY_RETENTION_DAYS = int(os.getenv("CLICK_DAILY_RETENTION_DAYS", "730"))
+COMPACT_INTERVAL = float(os.getenv("CLICK_COMPACT_INTERVAL", "3600"))
+
+
+class ClickEventBuffer:
+    def __init__(self, hourly_retention_days: int, daily_retention_days: int):
+        self.hourly_retention = hourly_retention_days * DAY
+        self.daily_retention = daily_retention_days * DAY
+        self._events = []
+        self._lock = threading.Lock()
+        self._last_compact = 0.0
+
+    def append(self, short_code: str, ts: float | None = None):
+        with self._lock:
+            self._events.append((short_code, int(ts if ts is not None else time.time())))
+
+    def drain(self) -> list[tuple[str, int]]:
+        with self._lock:
+            events, self._events = self._events, []
+        return events
+
+    def restore(self, events: list[tuple[str, int]]):
+        with self._lock:
+            self._events[:0] = events
+
+    def discard(self, short_code: str):
+        with self._lock:
+            self._events = [event for event in self._events if event[0] != short_code]
+
+    def write_rollups(self, conn, events: list[tuple[str, int]]):
+        buckets = Counter((code, ts - ts % HOUR) for code, ts in events)
+        # Clicks for a link deleted after they were buffered are dropped.
+        conn.executemany(
+            """
+            INSERT INTO click_rollups (short_code, granularity, bucket_start, count)
+            SELECT ?1, 'hour', ?2, ?3 WHERE EXISTS (SELECT 1 FROM urls WHERE short_code = ?1)
+            ON CONFLICT (short_code, granularity, bucket_start)
+            DO UPDATE SET count = count + excluded.count
+            """,
+            [(code, bucket, count) for (code, bucket), count in buckets.items()],
+        )
+
+    def compact(self, conn, now: float | None = None):
+        now = int(now if now is not None else time.time())
+        hourly_cutoff = now - now % DAY - self.hourly_retention
+        conn.execute(
+            """
+            INSERT INTO click_rollups (short_code, granularity, bucket_start, count)
+            SELECT short_code, 'day', bucket_start - bucket_start % 86400, SUM(count)
+            FROM click_rollups
+            WHERE granularity = 'hour' AND bucket_start < ?
+            GROUP BY short_code, bucket_start - bucket_start % 86400
+            ON CONFLICT (short_code, granularity, bucket_start)
+            DO UPDATE SET count = count + excluded.count
+            """,
+            (hourly_cutoff,),
+        )
+        conn.execute(
+            "DELETE FROM click_rollups WHERE granularity = 'hour' AND bucket_start < ?",
+            (hourly_cutoff,),
+        )
+        conn.execute(
+            "DELETE FROM click_rollups WHERE granularity = 'day' AND bucket_start < ?",
+            (now - now % DAY - self.daily_retention,),
+        )
+        self._last_compact = time.monotonic()
+
+    def compact_due(self) -> bool:
+        return time.monotonic() - self._last_compact >= COMPACT_INTERVAL
+
+    def timeseries(self, conn, short_code: str, granularity: str, start: int, end: int):
+        size = HOUR if granularity == "hour" else DAY
+        rows = conn.execute(
+            """
+            SELECT bucket_start - bucket_start % ? AS bucket, SUM(count) AS count
+            FROM click_rollups
+            WHERE short_code = ? AND bucket_start >= ? AND bucket_start < ?
+              AND (granularity = 'hour' OR ? = 'day')
+            GROUP BY bucket
+            ORDER BY bucket
+            """,
+            (size, short_code, start - start % size, end, granularity),
+        ).fetchall()
+        return [(row["bucket"], row["count"]) for row in rows]
+
+
+click_events = ClickEventBuffer(HOURLY_RETENTION_DAYS, DAILY_RETENTION_DAYS)
@@ -0,0 +1,71 @@
+import asyncio
+import itertools
+import os
+import sqlite3
+
+import aiosqlite
+
+import database
+from metrics import TimedConnection, stage_duration
+
+READERS = int(os.getenv("ASYNC_DB_READERS", "4"))
+
+
+class AsyncDatabase:
+    """Persistent aiosqlite connections for the async read paths.
+
+    Each connection runs on its own worker thread, so awaiting a query never
+    holds a Starlette threadpool slot. Writes stay on the click flusher thread.
+    Every shard gets its own set of readers.
+    """
+
+    def __init__(self, readers: int):
+        self.readers = readers
+        self._conns = []
+        self._cycles = []
+        self._lock = None
+
+    async def _connect(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._conns:
+                return
+            shards = []
+            for index in range(len(database.pools)):
+                conns = []
+                for _ in range(self.readers):
+                    with stage_duration.time("connection_open"):
+                        conn = await aiosqlite.connect(
+                            database.shard_path(index), factory=TimedConnection
+                        )
+                        conn.row_factory = sqlite3.Row
+                        for pragma in database.PRAGMAS:
+                            await conn.execute(pragma)
+                    conns.append(conn)
+                shards.append(conns)
+            self._cycles = [itertools.cycle(conns) for conns in shards]
+            self._conns = shards
+
+    async def fetchone(self, sql: str, params=(), shard: int = 0):
+        if not self._conns:
+            await self._connect()
+        async with next(self._cycles[shard]).execute(sql, params) as cursor:
+            return await cursor.fetchone()
+
+    async def fetchall(self, sql: str, params=(), shard: int = 0):
+        if not self._conns:
+            await self._connect()
+        async with next(self._cycles[shard]).execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+    async def close(self):
+        shards, self._conns = self._conns, []
+        self._cycles = []
+        self._lock = None
+        for conns in shards:
+            for conn in conns:
+                await conn.close()
+
+
+async_db = AsyncDatabase(READERS)
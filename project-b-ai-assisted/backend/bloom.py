@@ -0,0 +1,208 @@
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+from async_db import async_db
+from database import pools
+from shared_table import shared_table
+
+ERROR_RATE = float(os.getenv("BLOOM_ERROR_RATE", "0.01"))
+MIN_CAPACITY = int(os.getenv("BLOOM_MIN_CAPACITY", "100000"))
+SYNC_INTERVAL = float(os.getenv("BLOOM_SYNC_INTERVAL", "1.0"))
+REBUILD_INTERVAL = float(os.getenv("BLOOM_REBUILD_INTERVAL", "600"))
+# Without a shared table generation to compare, a miss syncs first once the filter is this old.
+MAX_STALENESS = float(os.getenv("BLOOM_MAX_STALENESS", "2.0"))
+NEW_CODES_SQL = "SELECT id, short_code FROM urls WHERE id > ? ORDER BY id"
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class ShortCodeFilter:
+    """Bloom filter over urls.short_code used to reject unknown codes without a query.
+
+    Codes created in this process are added immediately; codes created by other
+    workers are picked up by tailing urls.id on each shard every SYNC_INTERVAL
+    seconds, and the whole filter is rebuilt every REBUILD_INTERVAL seconds to
+    forget deleted codes. A miss is answered from memory unless the shared table's
+    generation has moved since the last sync (another worker stored a code) or the
+    last sync is older than MAX_STALENESS; then confirm_miss() catches up first.
+    Until the first build finishes every code is treated as a possible hit.
+    """
+
+    def __init__(self, error_rate: float, min_capacity: int):
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.rejected = 0
+        self._filter = None
+        self._last_ids = {}
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._building = False
+        self._pending = []
+        self._synced_at = 0.0
+        self._generation = None
+        self.catch_ups = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def might_contain(self, short_code: str) -> bool:
+        bloom = self._filter
+        return bloom is None or short_code in bloom
+
+    def add(self, short_code: str):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(short_code)
+            if self._building:
+                self._pending.append(short_code)
+
+    def rebuild(self):
+        with self._build_lock:
+            with self._lock:
+                self._building = True
+                self._pending = []
+            try:
+                total, last_ids = 0, {}
+                for shard, shard_pool in enumerate(pools):
+                    with shard_pool.connection() as conn:
+                        count, last_id = conn.execute("SELECT COUNT(*), MAX(id) FROM urls").fetchone()
+                    total += count
+                    last_ids[shard] = last_id or 0
+                bloom = BloomFilter(max(total * 2, self.min_capacity), self.error_rate)
+                for shard, shard_pool in enumerate(pools):
+                    with shard_pool.connection() as conn:
+                        for (code,) in conn.execute(
+                            "SELECT short_code FROM urls WHERE id <= ?", (last_ids[shard],)
+                        ):
+                            bloom.add(code)
+                with self._lock:
+                    for code in self._pending:
+                        bloom.add(code)
+                    self._filter = bloom
+                    self._last_ids = last_ids
+            finally:
+                with self._lock:
+                    self._building = False
+                    self._pending = []
+        self.sync()
+
+    def _apply(self, shard: int, rows):
+        if rows:
+            with self._lock:
+                for row in rows:
+                    self._filter.add(row["short_code"])
+                self._last_ids[shard] = max(self._last_ids.get(shard, 0), rows[-1]["id"])
+
+    def _synced(self, generation, started: float):
+        self._generation = generation
+        self._synced_at = max(self._synced_at, started)
+
+    def stale(self) -> bool:
+        generation = shared_table.generation()
+        if generation is not None and generation != self._generation:
+            return True
+        return time.monotonic() - self._synced_at > MAX_STALENESS
+
+    async def confirm_miss(self, short_code: str) -> bool:
+        """Return True if a code that missed the filter really doesn't exist.
+
+        Reads new codes on the event loop through async_db only when stale() says
+        another worker may have added some; otherwise the answer comes from memory.
+        """
+        if self.stale():
+            self.catch_ups += 1
+            generation, started = shared_table.generation(), time.monotonic()
+            for shard in range(len(pools)):
+                rows = await async_db.fetchall(NEW_CODES_SQL, (self._last_ids.get(shard, 0),), shard)
+                self._apply(shard, rows)
+            self._synced(generation, started)
+        if self.might_contain(short_code):
+            return False
+        self.rejected += 1
+        return True
+
+    def sync(self):
+        if self._filter is None:
+            return
+        generation, started = shared_table.generation(), time.monotonic()
+        with self._build_lock:
+            for shard, shard_pool in enumerate(pools):
+                with shard_pool.connection() as conn:
+                    rows = conn.execute(NEW_CODES_SQL, (self._last_ids.get(shard, 0),)).fetchall()
+                self._apply(shard, rows)
+            self._synced(generation, started)
+        if self._filter.count > self._filter.capacity:
+            self.rebuild()
+
+    def reset(self):
+        with self._lock:
+            self._filter = None
+            self._last_ids = {}
+            self.rejected = 0
+            self.catch_ups = 0
+
+    def stats(self) -> dict:
+        bloom = self._filter
+        return {
+            "ready": bloom is not None,
+            "bits": bloom.size if bloom else 0,
+            "entries": bloom.count if bloom else 0,
+            "rejected": self.rejected,
+            "catch_ups": self.catch_ups,
+        }
+
+    def _run(self):
+        last_rebuild = time.monotonic()
+        while not self._stopping.wait(SYNC_INTERVAL):
+            try:
+                if time.monotonic() - last_rebuild >= REBUILD_INTERVAL:
+                    self.rebuild()
+                    last_rebuild = time.monotonic()
+                else:
+                    self.sync()
+            except Exception:
+                logger.exception("short code filter refresh failed")
+
+    def start(self):
+        self.rebuild()
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="bloom-sync", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+
+short_code_filter = ShortCodeFilter(ERROR_RATE, MIN_CAPACITY)
@@ -0,0 +1,136 @@
+import logging
+import os
+import threading
+from collections import Counter, defaultdict
+
+from analytics import click_events
+from database import pools, shard_for
+
+FLUSH_INTERVAL = float(os.getenv("CLICK_FLUSH_INTERVAL", "1.0"))
+FLUSH_THRESHOLD = int(os.getenv("CLICK_FLUSH_THRESHOLD", "1000"))
+
+logger = logging.getLogger(__name__)
+
+
+class ClickAggregator:
+    def __init__(self, interval: float, threshold: int):
+        self.interval = interval
+        self.threshold = threshold
+        self._pending = Counter()
+        self._total = 0
+        self._discarded = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def record(self, short_code: str):
+        with self._lock:
+            self._pending[short_code] += 1
+            self._total += 1
+            full = self._total >= self.threshold
+        click_events.append(short_code)
+        if full:
+            if self._thread is not None:
+                self._wake.set()
+            else:
+                self.flush()
+
+    def pending(self, short_code: str) -> int:
+        with self._lock:
+            return self._pending.get(short_code, 0)
+
+    def pending_total(self) -> int:
+        with self._lock:
+            return self._total
+
+    def discard(self, short_code: str):
+        """Drop a deleted link's buffered clicks; delete_link removes its rollups itself.
+
+        The code is also remembered until the next drain, so a flush that already took
+        its events skips them instead of writing them after the delete.
+        """
+        with self._lock:
+            self._total -= self._pending.pop(short_code, 0)
+            self._discarded.add(short_code)
+            click_events.discard(short_code)
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, Counter()
+                self._total = 0
+                discarded = self._discarded = set()
+                events = click_events.drain()
+            if not batch and not events:
+                return 0
+            shards = defaultdict(lambda: (Counter(), []))
+            for code, count in batch.items():
+                shards[shard_for(code)][0][code] = count
+            for code, ts in events:
+                shards[shard_for(code)][1].append((code, ts))
+            # One transaction per shard; on failure only the shards not yet written are put back.
+            remaining = dict(shards)
+            try:
+                for shard, (counts, shard_events) in shards.items():
+                    with pools[shard].connection() as conn:
+                        # Holding the write lock, a delete has either committed (and marked
+                        # the code discarded, or the urls row is gone) or waits for this.
+                        conn.execute("BEGIN IMMEDIATE")
+                        with self._lock:
+                            dropped = set(discarded)
+                        if dropped:
+                            counts = Counter({c: n for c, n in counts.items() if c not in dropped})
+                            shard_events = [event for event in shard_events if event[0] not in dropped]
+                        conn.executemany(
+                            "UPDATE urls SET click_count = click_count + ? WHERE short_code = ?",
+                            [(count, code) for code, count in counts.items()],
+                        )
+                        click_events.write_rollups(conn, shard_events)
+                        conn.commit()
+                    del remaining[shard]
+            except Exception:
+                for counts, shard_events in remaining.values():
+                    with self._lock:
+                        self._pending.update(counts)
+                        self._total += sum(counts.values())
+                    click_events.restore(shard_events)
+                raise
+            return len(batch)
+
+    def compact(self):
+        with self._flush_lock:
+            for shard_pool in pools:
+                with shard_pool.connection() as conn:
+                    click_events.compact(conn)
+                    conn.commit()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+                if click_events.compact_due():
+                    self.compact()
+            except Exception:
+                logger.exception("click flush failed, will retry")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="click-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping = True
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+click_aggregator = ClickAggregator(FLUSH_INTERVAL, FLUSH_THRESHOLD)
@@ -0,0 +1,91 @@
+import hashlib
+import os
+import random
+import string
+import threading
+
+from database import get_connection
+
+CODE_LENGTH = 6
+CODE_ALLOCATOR = os.getenv("CODE_ALLOCATOR", "sequence")
+CODE_SECRET = os.getenv("CODE_SECRET", "dev-code-secret")
+CODE_BLOCK_SIZE = int(os.getenv("CODE_BLOCK_SIZE", "1000"))
+
+ALPHABET = string.digits + string.ascii_letters
+
+# 2**34 ids fit in six base62 characters (62**6 is about 2**35.7).
+HALF_BITS = 17
+HALF_MASK = (1 << HALF_BITS) - 1
+MAX_ID = 1 << (2 * HALF_BITS)
+ROUNDS = 4
+
+
+def base62(n: int, length: int = CODE_LENGTH) -> str:
+    chars = []
+    while n:
+        n, rem = divmod(n, 62)
+        chars.append(ALPHABET[rem])
+    return "".join(reversed(chars)).rjust(length, ALPHABET[0])
+
+
+class RandomAllocator:
+    def next_code(self) -> str:
+        return "".join(random.choices(ALPHABET, k=CODE_LENGTH))
+
+
+class SequenceAllocator:
+    """Hands out base62 codes for a Feistel-permuted counter.
+
+    Ids come from blocks reserved in the code_sequence table, so several
+    workers never hand out the same id and no existence query is needed.
+    """
+
+    def __init__(self, secret: str, block_size: int):
+        self.block_size = block_size
+        digest = hashlib.blake2b(secret.encode(), digest_size=4 * ROUNDS).digest()
+        self._keys = [int.from_bytes(digest[i:i + 4], "big") for i in range(0, len(digest), 4)]
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def permute(self, n: int) -> int:
+        left, right = n >> HALF_BITS, n & HALF_MASK
+        for key in self._keys:
+            mixed = ((right ^ key) * 0x9E3779B1) & 0xFFFFFFFF
+            mixed ^= mixed >> 15
+            left, right = right, left ^ (mixed & HALF_MASK)
+        return (left << HALF_BITS) | right
+
+    def _reserve(self):
+        conn = get_connection()
+        try:
+            row = conn.execute(
+                "UPDATE code_sequence SET next_id = next_id + ? WHERE name = 'urls' RETURNING next_id",
+                (self.block_size,),
+            ).fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+        self._end = row["next_id"]
+        self._next = self._end - self.block_size
+
+    def next_code(self) -> str:
+        with self._lock:
+            if self._next >= self._end:
+                self._reserve()
+            n = self._next
+            self._next += 1
+        if n >= MAX_ID:
+            raise RuntimeError("Short code space exhausted")
+        return base62(self.permute(n))
+
+
+def make_allocator(name: str):
+    if name == "random":
+        return RandomAllocator()
+    if name == "sequence":
+        return SequenceAllocator(CODE_SECRET, CODE_BLOCK_SIZE)
+    raise ValueError(f"Unknown code allocator: {name}")
+
+
+allocator = make_allocator(CODE_ALLOCATOR)
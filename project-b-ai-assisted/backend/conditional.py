@@ -0,0 +1,55 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request, Response
+
+VERSION_SQL = "SELECT version, updated_at FROM table_versions WHERE name = ?"
+CACHE_CONTROL = "private, no-cache"
+
+
+def table_version(conn, table: str):
+    return conn.execute(VERSION_SQL, (table,)).fetchone()
+
+
+def validators(version_row, *extra) -> tuple[str, str | None]:
+    """Return the ETag and, once its second has passed, the Last-Modified date.
+
+    Last-Modified only has one-second resolution, so a date from the current second
+    could be followed by another write that doesn't change it. Those are neither
+    sent nor trusted; the version-based ETag covers that window.
+    """
+    etag = '"' + "-".join(str(part) for part in (version_row["version"], *extra)) + '"'
+    modified = datetime.strptime(version_row["updated_at"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    if modified >= datetime.now(timezone.utc).replace(microsecond=0):
+        return etag, None
+    return etag, format_datetime(modified, usegmt=True)
+
+
+def is_fresh(request: Request, etag: str, last_modified: str | None) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def check(request: Request, response: Response, version_row, *extra):
+    """Set ETag/Last-Modified on response; return a 304 if the client's copy is current.
+
+    version_row comes from table_versions, which triggers bump on every write to
+    the table, so this costs one primary-key lookup instead of building the body.
+    """
+    etag, last_modified = validators(version_row, *extra)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+    if is_fresh(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
@@ -1,20 +1,204 @@
+import hashlib
 import sqlite3
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "urls.db")
+from metrics import TimedConnection, stage_duration
 
+DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.dirname(__file__), "urls.db"))
 
-def get_connection():
-    conn = sqlite3.connect(DB_PATH)
+# Starlette runs sync routes on anyio's default threadpool, which has 40 workers.
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "40"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# urls is split across this many files by a hash of short_code; shard 0 is DB_PATH itself.
+SHARDS = int(os.getenv("DB_SHARDS", "1"))
+# Shard N hands out AUTOINCREMENT ids from N << ID_SHIFT so urls.id stays unique across shards.
+ID_SHIFT = 40
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA mmap_size={int(os.getenv('DB_MMAP_SIZE', str(256 * 1024 * 1024)))}",
+    f"PRAGMA cache_size={int(os.getenv('DB_CACHE_SIZE', '-16000'))}",
+    f"PRAGMA busy_timeout={int(os.getenv('DB_BUSY_TIMEOUT', '5000'))}",
+)
+
+
+def shard_path(index: int, base: str | None = None) -> str:
+    base = base or DB_PATH
+    if index == 0:
+        return base
+    root, ext = os.path.splitext(base)
+    return f"{root}-{index}{ext}"
+
+
+def get_connection(path: str | None = None):
+    conn = sqlite3.connect(path or DB_PATH, check_same_thread=False, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
-def init_db():
-    conn = get_connection()
-    conn.execute("""
+class ConnectionPool:
+    def __init__(self, size: int, timeout: float, shard: int = 0):
+        self.size = size
+        self.timeout = timeout
+        self.shard = shard
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._acquired = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+        if conn is None:
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    with stage_duration.time("connection_open"):
+                        conn = get_connection(shard_path(self.shard))
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                start = time.perf_counter()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError("Timed out waiting for a database connection")
+                waited = time.perf_counter() - start
+                with self._lock:
+                    self._waits += 1
+                    self._wait_total += waited
+                    self._wait_max = max(self._wait_max, waited)
+        with self._lock:
+            self._acquired += 1
+        return conn
+
+    def _release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._opened,
+                "idle": self._idle.qsize(),
+                "acquired": self._acquired,
+                "waits": self._waits,
+                "wait_seconds_total": self._wait_total,
+                "wait_seconds_max": self._wait_max,
+            }
+
+
+pool = ConnectionPool(POOL_SIZE, POOL_TIMEOUT)
+pools = [pool] + [ConnectionPool(POOL_SIZE, POOL_TIMEOUT, i) for i in range(1, SHARDS)]
+
+
+def set_shards(count: int):
+    """Resize pools in place; pools[0] is kept so imported references to pool stay valid."""
+    for shard_pool in pools[count:]:
+        shard_pool.close()
+    del pools[max(count, 1):]
+    pools.extend(ConnectionPool(POOL_SIZE, POOL_TIMEOUT, i) for i in range(len(pools), count))
+
+
+def shard_for(short_code: str, count: int | None = None) -> int:
+    digest = hashlib.blake2b(short_code.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % (count or len(pools))
+
+
+def pool_for(short_code: str) -> ConnectionPool:
+    return pools[shard_for(short_code)]
+
+
+def get_db():
+    with pool.connection() as conn:
+        yield conn
+
+
+def get_link_db(short_code: str):
+    with pool_for(short_code).connection() as conn:
+        yield conn
+
+
+def url_hash(url: str) -> int:
+    digest = hashlib.blake2b(url.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def backfill_url_hash(conn):
+    rows = conn.execute("SELECT id, original_url FROM urls WHERE url_hash IS NULL").fetchall()
+    conn.executemany(
+        "UPDATE urls SET url_hash = ? WHERE id = ?",
+        [(url_hash(r["original_url"]), r["id"]) for r in rows],
+    )
+
+
+def table_version_steps(table: str) -> list[str]:
+    """Create table_versions and triggers that bump table's row on every write."""
+    bump = (
+        "UPDATE table_versions SET version = version + 1, updated_at = datetime('now')"
+        f" WHERE name = '{table}'"
+    )
+    return [
+        "CREATE TABLE IF NOT EXISTS table_versions ("
+        " name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0,"
+        " updated_at TEXT NOT NULL DEFAULT (datetime('now')))",
+        f"INSERT OR IGNORE INTO table_versions (name) VALUES ('{table}')",
+    ] + [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table}"
+        f" BEGIN {bump}; END"
+        for event in ("INSERT", "UPDATE", "DELETE")
+    ]
+
+
+# Each entry upgrades the schema by one PRAGMA user_version. Steps are SQL or callables.
+MIGRATIONS = [
+    [
+        """
         CREATE TABLE IF NOT EXISTS urls (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             short_code TEXT UNIQUE NOT NULL,
@@ -23,6 +207,74 @@ def init_db():
             created_at TEXT NOT NULL DEFAULT (datetime('now')),
             updated_at TEXT NOT NULL DEFAULT (datetime('now'))
         )
-    """)
+        """,
+    ],
+    [
+        "ALTER TABLE urls ADD COLUMN url_hash INTEGER",
+        backfill_url_hash,
+        "CREATE INDEX IF NOT EXISTS idx_urls_url_hash ON urls (url_hash)",
+        "CREATE INDEX IF NOT EXISTS idx_urls_created_at ON urls (created_at)",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS code_sequence (name TEXT PRIMARY KEY, next_id INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO code_sequence (name, next_id) VALUES ('urls', 0)",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS click_rollups (
+            short_code TEXT NOT NULL,
+            granularity TEXT NOT NULL,
+            bucket_start INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (short_code, granularity, bucket_start)
+        ) WITHOUT ROWID
+        """,
+    ],
+    table_version_steps("urls") + [
+        "ALTER TABLE urls ADD COLUMN permanent INTEGER NOT NULL DEFAULT 0",
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_urls_updated_at ON urls (updated_at)",
+    ],
+]
+
+
+def migrate(conn):
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(MIGRATIONS):
+            conn.commit()
+            return version
+        try:
+            for step in MIGRATIONS[version]:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def reserve_id_range(conn, index: int):
+    base = index << ID_SHIFT
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'urls'").fetchone()
+    if row is None:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('urls', ?)", (base,))
+    elif row[0] < base:
+        conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'urls'", (base,))
     conn.commit()
-    conn.close()
+
+
+def init_db():
+    for index in range(len(pools)):
+        conn = get_connection(shard_path(index))
+        try:
+            migrate(conn)
+            if index:
+                reserve_id_range(conn, index)
+        finally:
+            conn.close()
@@ -0,0 +1,39 @@
+import json
+import os
+
+from fastapi import Response
+
+from metrics import stage_duration
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Opt-in: routes encode rows straight to JSON bytes instead of building response models.
+ENABLED = os.getenv("FAST_JSON", "0") == "1"
+
+
+def raw(text: str):
+    """Embed text that is already JSON (like notes.tags) without decoding it."""
+    if orjson is not None:
+        return orjson.Fragment(text)
+    return json.loads(text)
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def response(content, response: Response) -> Response:
+    """Encode content and carry over the headers a route set on its injected response.
+
+    FastAPI doesn't validate or re-encode a returned Response, so the route's
+    response_model only documents the body here.
+    """
+    headers = {k: v for k, v in response.headers.items() if k != "content-length"}
+    with stage_duration.time("serialize"):
+        body = dumps(content)
+    return Response(body, media_type="application/json", headers=headers)
@@ -1,8 +1,16 @@
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
-from database import init_db
+from admission import AdmissionMiddleware
+from async_db import async_db
+from bloom import short_code_filter
+from cache import link_cache
+from clicks import click_aggregator
+from database import init_db, pools
+from metrics import MetricsMiddleware, TimedJSONResponse, registry
+from shared_table import shared_table
 from routes.links import router as links_router
 from routes.redirect import router as redirect_router
 
@@ -10,20 +18,72 @@ from routes.redirect import router as redirect_router
 @asynccontextmanager
 async def lifespan(app):
     init_db()
+    shared_table.start()
+    short_code_filter.start()
+    click_aggregator.start()
     yield
+    click_aggregator.stop()
+    short_code_filter.stop()
+    shared_table.stop()
+    await async_db.close()
+    for shard_pool in pools:
+        shard_pool.close()
 
 
-app = FastAPI(title="URL Shortener", version="0.1.0", lifespan=lifespan)
+@registry.collector
+def runtime_stats():
+    shard_stats = [shard_pool.stats() for shard_pool in pools]
+    db = {key: sum(s[key] for s in shard_stats) for key in ("open", "idle", "acquired", "waits", "wait_seconds_total")}
+    db["wait_seconds_max"] = max(s["wait_seconds_max"] for s in shard_stats)
+    cache = link_cache.stats()
+    bloom = short_code_filter.stats()
+    table = shared_table.stats()
+    return [
+        ("db_pool_open_connections", "gauge", "Open pooled SQLite connections.", db["open"]),
+        ("db_pool_idle_connections", "gauge", "Idle pooled SQLite connections.", db["idle"]),
+        ("db_pool_acquired_total", "counter", "Connections handed out by the pool.", db["acquired"]),
+        ("db_pool_waits_total", "counter", "Acquisitions that had to wait.", db["waits"]),
+        ("db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection.", db["wait_seconds_total"]),
+        ("db_pool_wait_seconds_max", "gauge", "Longest wait for a connection.", db["wait_seconds_max"]),
+        ("redirect_cache_entries", "gauge", "Short codes in the redirect cache.", cache["size"]),
+        ("redirect_cache_hits_total", "counter", "Redirect cache hits.", cache["hits"]),
+        ("redirect_cache_misses_total", "counter", "Redirect cache misses.", cache["misses"]),
+        ("shared_table_entries", "gauge", "Live short codes in the shared table.", table["live"]),
+        ("shared_table_hits_total", "counter", "Redirects answered from the shared table.", table["hits"]),
+        ("shared_table_misses_total", "counter", "Shared table lookups that fell through.", table["misses"]),
+        ("short_code_filter_bits", "gauge", "Size of the short code Bloom filter.", bloom["bits"]),
+        ("short_code_filter_rejections_total", "counter", "Redirects rejected by the Bloom filter.", bloom["rejected"]),
+        ("short_code_filter_catch_ups_total", "counter", "Syncs run because a code missed the Bloom filter.", bloom["catch_ups"]),
+        ("clicks_pending", "gauge", "Clicks buffered but not yet flushed.", click_aggregator.pending_total()),
+    ]
+
+
+app = FastAPI(
+    title="URL Shortener",
+    version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=TimedJSONResponse,
+)
+# Innermost, so shed requests still get CORS headers and show up in request metrics.
+app.add_middleware(AdmissionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
 app.include_router(links_router)
 app.include_router(redirect_router)
@@ -6,6 +6,7 @@ from typing import Optional
 class LinkCreate(BaseModel):
     original_url: str = Field(min_length=5, max_length=2000)
     custom_code: Optional[str] = Field(default=None, min_length=3, max_length=20)
+    permanent: bool = False
 
     @field_validator("original_url")
     @classmethod
@@ -22,6 +23,7 @@ class LinkResponse(BaseModel):
     original_url: str
     short_url: str
     click_count: int
+    permanent: bool
     created_at: str
     updated_at: str
 
@@ -31,3 +33,21 @@ class LinkStats(BaseModel):
     original_url: str
     click_count: int
     created_at: str
+
+
+class ClickBucket(BaseModel):
+    bucket_start: str
+    count: int
+
+
+class LinkTimeseries(BaseModel):
+    short_code: str
+    granularity: str
+    buckets: list[ClickBucket]
+
+
+class BulkLinkResult(BaseModel):
+    index: int
+    status: str
+    link: Optional[LinkResponse] = None
+    detail: Optional[str] = None
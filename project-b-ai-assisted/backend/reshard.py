@@ -0,0 +1,101 @@
+"""Move every link onto a different number of shard files.
+
+    DB_SHARDS=2 python reshard.py 4
+
+Run it with the server stopped and DB_SHARDS set to the current shard count,
+then start the server with DB_SHARDS set to the new one. The old files are kept
+next to the new ones with a .pre-reshard suffix. Links get new ids on their new
+shard; short codes, click counts and click rollups carry over.
+"""
+import argparse
+import os
+import sys
+
+import database
+from database import get_connection, migrate, reserve_id_range, shard_for, shard_path
+
+COPY_BATCH = 10_000
+URL_COLUMNS = "short_code, original_url, url_hash, click_count, created_at, updated_at, permanent"
+ROLLUP_COLUMNS = "short_code, granularity, bucket_start, count"
+
+
+def copy_table(source, targets, table: str, columns: str, order: str):
+    marks = ", ".join("?" for _ in columns.split(","))
+    cursor = source.execute(f"SELECT {columns} FROM {table} ORDER BY {order}")
+    while True:
+        rows = cursor.fetchmany(COPY_BATCH)
+        if not rows:
+            break
+        batches = [[] for _ in targets]
+        for row in rows:
+            batches[shard_for(row["short_code"], len(targets))].append(tuple(row))
+        for target, batch in zip(targets, batches):
+            if batch:
+                target.executemany(f"INSERT INTO {table} ({columns}) VALUES ({marks})", batch)
+
+
+def close_without_wal(conn):
+    # Leaves no -wal/-shm files behind, so renaming the database file is safe.
+    conn.commit()
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.close()
+
+
+def reshard(old_count: int, new_count: int, base: str, codes_path: str | None = None):
+    old_paths = [shard_path(i, base) for i in range(old_count)]
+    missing = [path for path in old_paths if not os.path.exists(path)]
+    if missing:
+        raise SystemExit(f"missing shard files: {', '.join(missing)}")
+    new_paths = [shard_path(i, base) for i in range(new_count)]
+    staged = [f"{path}.reshard" for path in new_paths]
+
+    targets = []
+    for index, path in enumerate(staged):
+        if os.path.exists(path):
+            os.remove(path)
+        conn = get_connection(path)
+        migrate(conn)
+        reserve_id_range(conn, index)
+        targets.append(conn)
+
+    for index, path in enumerate(old_paths):
+        source = get_connection(path)
+        copy_table(source, targets, "urls", URL_COLUMNS, "id")
+        copy_table(source, targets, "click_rollups", ROLLUP_COLUMNS, "short_code")
+        if index == 0:
+            for row in source.execute("SELECT name, next_id FROM code_sequence"):
+                targets[0].execute(
+                    "INSERT OR REPLACE INTO code_sequence (name, next_id) VALUES (?, ?)", tuple(row)
+                )
+        close_without_wal(source)
+        print(f"copied {path}")
+
+    for conn in targets:
+        close_without_wal(conn)
+    for path in old_paths:
+        os.replace(path, f"{path}.pre-reshard")
+    for path, staged_path in zip(new_paths, staged):
+        os.replace(staged_path, path)
+
+    # Workers rebuild the shared short code table from the new shards on startup.
+    codes_path = codes_path or base + ".codes"
+    if os.path.exists(codes_path):
+        os.remove(codes_path)
+    print(f"resharded {old_count} -> {new_count} shard(s); set DB_SHARDS={new_count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("shards", type=int, help="new shard count")
+    parser.add_argument("--from", dest="old", type=int, default=database.SHARDS,
+                        help="current shard count (default: DB_SHARDS)")
+    parser.add_argument("--db", default=database.DB_PATH, help="shard 0 path (default: DB_PATH)")
+    parser.add_argument("--codes", help="shared short code table to discard (default: <db>.codes)")
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error("shards must be at least 1")
+    reshard(args.old, args.shards, args.db, args.codes)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
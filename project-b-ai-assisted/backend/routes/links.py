@@ -1,19 +1,48 @@
-import string
-import random
-from datetime import datetime, timezone
+import csv
+import heapq
+import io
+import json
+import os
+import sqlite3
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
 
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 
+import conditional
+import fastjson
+from analytics import DAY, HOUR, click_events
+from async_db import async_db
 from auth import verify_api_key
-from database import get_connection
-from models import LinkCreate, LinkResponse, LinkStats
+from bloom import short_code_filter
+from cache import link_cache
+from clicks import click_aggregator
+from shared_table import shared_table
+from codes import allocator
+from database import get_link_db, pool_for, pools, shard_for, url_hash
+from metrics import stage_duration
+from models import (
+    BulkLinkResult,
+    ClickBucket,
+    LinkCreate,
+    LinkResponse,
+    LinkStats,
+    LinkTimeseries,
+)
 
 router = APIRouter(prefix="/api/links", tags=["links"], dependencies=[Depends(verify_api_key)])
 
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+EXPORT_FIELDS = ["id", "short_code", "original_url", "short_url", "click_count", "created_at", "updated_at"]
 
-def generate_code(length=6):
-    chars = string.ascii_letters + string.digits
-    return "".join(random.choices(chars, k=length))
+INSERT_LINK = (
+    "INSERT INTO urls (short_code, original_url, url_hash, created_at, updated_at, permanent)"
+    " VALUES (?, ?, ?, ?, ?, ?)"
+)
 
 
 def make_short_url(request: Request, code: str) -> str:
@@ -27,71 +56,428 @@ def row_to_response(row, short_url: str) -> LinkResponse:
         original_url=row["original_url"],
         short_url=short_url,
         click_count=row["click_count"],
+        permanent=bool(row["permanent"]),
         created_at=row["created_at"],
         updated_at=row["updated_at"],
     )
 
 
+def row_to_dict(row, short_url: str) -> dict:
+    return {
+        "id": row["id"],
+        "short_code": row["short_code"],
+        "original_url": row["original_url"],
+        "short_url": short_url,
+        "click_count": row["click_count"],
+        "permanent": bool(row["permanent"]),
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
+
+
+def group_by_shard(items, code=lambda item: item) -> dict[int, list]:
+    shards = defaultdict(list)
+    for item in items:
+        shards[shard_for(code(item))].append(item)
+    return shards
+
+
+def find_existing(urls: set[str]) -> dict:
+    """Existing rows for urls, keyed by original_url. Links are sharded by code, so every shard is asked."""
+    hashes = list({url_hash(url) for url in urls})
+    existing = {}
+    if not hashes:
+        return existing
+    for shard_pool in pools:
+        with shard_pool.connection() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM urls WHERE url_hash IN ({placeholders(hashes)})", hashes
+            ).fetchall()
+        for row in rows:
+            if row["original_url"] in urls:
+                existing.setdefault(row["original_url"], row)
+    return existing
+
+
 @router.post("", response_model=LinkResponse, status_code=201)
 def create_link(link: LinkCreate, request: Request):
-    conn = get_connection()
-
-    existing = conn.execute(
-        "SELECT * FROM urls WHERE original_url = ?", (link.original_url,)
-    ).fetchone()
+    existing = find_existing({link.original_url}).get(link.original_url)
     if existing:
-        short_url = make_short_url(request, existing["short_code"])
-        conn.close()
-        return row_to_response(existing, short_url)
+        return row_to_response(existing, make_short_url(request, existing["short_code"]))
 
-    code = link.custom_code or generate_code()
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    values = [None, link.original_url, url_hash(link.original_url), now, now, int(link.permanent)]
+    while True:
+        values[0] = link.custom_code or allocator.next_code()
+        with pool_for(values[0]).connection() as conn:
+            try:
+                cursor = conn.execute(INSERT_LINK, values)
+            except sqlite3.IntegrityError:
+                if link.custom_code:
+                    raise HTTPException(status_code=409, detail="Short code already taken")
+                # A custom code already took this generated one; move on to the next.
+                continue
+            conn.commit()
+            row = conn.execute("SELECT * FROM urls WHERE id = ?", (cursor.lastrowid,)).fetchone()
+        break
+    short_code_filter.add(values[0])
+    shared_table.put(values[0], link.original_url, link.permanent)
+    return row_to_response(row, make_short_url(request, row["short_code"]))
 
-    if conn.execute("SELECT 1 FROM urls WHERE short_code = ?", (code,)).fetchone():
-        conn.close()
-        raise HTTPException(status_code=409, detail="Short code already taken")
 
-    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-    cursor = conn.execute(
-        "INSERT INTO urls (short_code, original_url, created_at, updated_at) VALUES (?, ?, ?, ?)",
-        (code, link.original_url, now, now),
-    )
+def epoch(value: datetime) -> float:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def placeholders(values) -> str:
+    return ", ".join("?" for _ in values)
+
+
+def insert_chunk(conn, rows: list[list], custom: set[str]) -> tuple[list[list], list[list]]:
+    """Insert rows into one shard; return (inserted, rows whose generated code was taken)."""
+    try:
+        conn.executemany(INSERT_LINK, rows)
+        conn.commit()
+        return rows, []
+    except sqlite3.IntegrityError:
+        conn.rollback()
+    # Some code in the chunk is already taken, so fall back to one insert per row.
+    inserted, clashed = [], []
+    for row in rows:
+        try:
+            conn.execute(INSERT_LINK, row)
+            inserted.append(row)
+        except sqlite3.IntegrityError:
+            if row[0] not in custom:
+                clashed.append(row)
     conn.commit()
-    row = conn.execute("SELECT * FROM urls WHERE id = ?", (cursor.lastrowid,)).fetchone()
-    short_url = make_short_url(request, row["short_code"])
-    conn.close()
-    return row_to_response(row, short_url)
+    return inserted, clashed
+
+
+def insert_rows(rows: list[list], custom: set[str]) -> list[list]:
+    inserted = []
+    while rows:
+        retry = []
+        for shard, shard_rows in group_by_shard(rows, lambda row: row[0]).items():
+            with pools[shard].connection() as conn:
+                done, clashed = insert_chunk(conn, shard_rows, custom)
+            inserted.extend(done)
+            # A new code can land on another shard, so clashes go round again.
+            for row in clashed:
+                row[0] = allocator.next_code()
+                retry.append(row)
+        rows = retry
+    return inserted
+
+
+def create_links_chunk(items: list[tuple[int, object]], base_url: str) -> list[BulkLinkResult]:
+    results = {}
+    links = {}
+    for index, raw in items:
+        if isinstance(raw, BulkLinkResult):
+            results[index] = raw
+            continue
+        try:
+            links[index] = LinkCreate.model_validate(raw)
+        except ValidationError as e:
+            detail = "; ".join(err["msg"] for err in e.errors())
+            results[index] = BulkLinkResult(index=index, status="invalid", detail=detail)
+
+    existing = find_existing({link.original_url for link in links.values()})
+    custom = {link.custom_code for link in links.values() if link.custom_code}
+    taken = set()
+    for shard, codes in group_by_shard(custom).items():
+        with pools[shard].connection() as conn:
+            rows = conn.execute(
+                f"SELECT short_code FROM urls WHERE short_code IN ({placeholders(codes)})", codes
+            ).fetchall()
+        taken.update(row["short_code"] for row in rows)
+
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    to_insert = []
+    queued = set()
+    for index, link in links.items():
+        url = link.original_url
+        if url in existing or url in queued:
+            continue
+        if link.custom_code:
+            if link.custom_code in taken:
+                results[index] = BulkLinkResult(
+                    index=index, status="conflict", detail="Short code already taken"
+                )
+                continue
+            taken.add(link.custom_code)
+            code = link.custom_code
+        else:
+            code = allocator.next_code()
+        queued.add(url)
+        to_insert.append([code, url, url_hash(url), now, now, int(link.permanent)])
+
+    inserted_rows = insert_rows(to_insert, custom)
+    for code, url, _, _, _, permanent in inserted_rows:
+        short_code_filter.add(code)
+        shared_table.put(code, url, bool(permanent))
+    created = {}
+    for shard, codes in group_by_shard([row[0] for row in inserted_rows]).items():
+        with pools[shard].connection() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM urls WHERE short_code IN ({placeholders(codes)})", codes
+            ).fetchall()
+        created.update((row["original_url"], row) for row in rows)
+
+    reported = set()
+    for index, link in links.items():
+        if index in results:
+            continue
+        url = link.original_url
+        if url in existing:
+            row, status = existing[url], "existing"
+        elif url in created:
+            row = created[url]
+            status = "existing" if url in reported else "created"
+        else:
+            results[index] = BulkLinkResult(
+                index=index, status="conflict", detail="Short code already taken"
+            )
+            continue
+        reported.add(url)
+        results[index] = BulkLinkResult(
+            index=index,
+            status=status,
+            link=row_to_response(row, f"{base_url}{row['short_code']}"),
+        )
+    return [results[index] for index, _ in items]
+
+
+async def read_ndjson(request: Request):
+    index = 0
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield index, line
+                index += 1
+    if buffer.strip():
+        yield index, buffer
+
+
+def parse_line(index: int, line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return BulkLinkResult(index=index, status="invalid", detail="Invalid JSON")
+
+
+@router.post(
+    "/bulk",
+    response_model=list[BulkLinkResult],
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {"type": "array", "items": {"$ref": "#/components/schemas/LinkCreate"}}
+                },
+                "application/x-ndjson": {
+                    "schema": {"$ref": "#/components/schemas/LinkCreate"}
+                },
+            },
+        }
+    },
+)
+async def create_links_bulk(request: Request):
+    base_url = str(request.base_url)
+    results = []
+    if "ndjson" in request.headers.get("content-type", ""):
+        chunk = []
+        async for index, line in read_ndjson(request):
+            chunk.append((index, parse_line(index, line)))
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                results.extend(await run_in_threadpool(create_links_chunk, chunk, base_url))
+                chunk = []
+        if chunk:
+            results.extend(await run_in_threadpool(create_links_chunk, chunk, base_url))
+        return results
+
+    try:
+        items = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    for start in range(0, len(items), BULK_CHUNK_SIZE):
+        chunk = list(enumerate(items[start:start + BULK_CHUNK_SIZE], start))
+        results.extend(await run_in_threadpool(create_links_chunk, chunk, base_url))
+    return results
+
+
+def urls_version() -> dict:
+    versions = []
+    for shard_pool in pools:
+        with shard_pool.connection() as conn:
+            versions.append(conditional.table_version(conn, "urls"))
+    # Each shard's version only goes up, so the sum changes whenever any shard is written.
+    return {
+        "version": sum(v["version"] for v in versions),
+        "updated_at": max(v["updated_at"] for v in versions),
+    }
 
 
 @router.get("", response_model=list[LinkResponse])
-def list_links(request: Request):
-    conn = get_connection()
-    rows = conn.execute("SELECT * FROM urls ORDER BY created_at DESC").fetchall()
-    conn.close()
-    return [row_to_response(r, make_short_url(request, r["short_code"])) for r in rows]
+def list_links(request: Request, response: Response):
+    not_modified = conditional.check(request, response, urls_version())
+    if not_modified:
+        return not_modified
+    shard_rows = []
+    for shard_pool in pools:
+        with shard_pool.connection() as conn:
+            shard_rows.append(conn.execute("SELECT * FROM urls ORDER BY created_at DESC").fetchall())
+    rows = heapq.merge(*shard_rows, key=lambda r: r["created_at"], reverse=True)
+    if fastjson.ENABLED:
+        base_url = str(request.base_url)
+        with stage_duration.time("fast_json"):
+            return fastjson.response([row_to_dict(r, base_url + r["short_code"]) for r in rows], response)
+    with stage_duration.time("row_to_response"):
+        return [row_to_response(r, make_short_url(request, r["short_code"])) for r in rows]
+
+
+def format_rows(rows, fmt: str, base_url: str) -> str:
+    if fmt == "csv":
+        out = io.StringIO()
+        writer = csv.writer(out)
+        for r in rows:
+            writer.writerow([
+                r["id"], r["short_code"], r["original_url"], base_url + r["short_code"],
+                r["click_count"], r["created_at"], r["updated_at"],
+            ])
+        return out.getvalue()
+    return "".join(
+        json.dumps({
+            "id": r["id"],
+            "short_code": r["short_code"],
+            "original_url": r["original_url"],
+            "short_url": base_url + r["short_code"],
+            "click_count": r["click_count"],
+            "created_at": r["created_at"],
+            "updated_at": r["updated_at"],
+        }) + "\n"
+        for r in rows
+    )
+
+
+def export_rows(sql: str, params: list, fmt: str, base_url: str):
+    if fmt == "csv":
+        out = io.StringIO()
+        csv.writer(out).writerow(EXPORT_FIELDS)
+        yield out.getvalue()
+    # Every id on shard N is above every id on shard N-1, so walking the shards in order keeps ids sorted.
+    for shard_pool in pools:
+        with shard_pool.connection() as conn:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                yield format_rows(rows, fmt, base_url)
+
+
+@router.get("/export")
+def export_links(
+    request: Request,
+    fmt: str = Query(default="ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    created_after: datetime | None = Query(default=None),
+    min_clicks: int | None = Query(default=None, ge=0),
+):
+    click_aggregator.flush()
+    clauses = []
+    params = []
+    if created_after:
+        clauses.append("created_at > ?")
+        if created_after.tzinfo is not None:
+            created_after = created_after.astimezone(timezone.utc)
+        # created_at is stored as "YYYY-MM-DD HH:MM:SS" UTC, so compare in that exact form.
+        params.append(created_after.strftime("%Y-%m-%d %H:%M:%S"))
+    if min_clicks is not None:
+        clauses.append("click_count >= ?")
+        params.append(min_clicks)
+    where = " AND ".join(clauses) if clauses else "1=1"
+    sql = (
+        "SELECT id, short_code, original_url, click_count, created_at, updated_at"
+        f" FROM urls WHERE {where} ORDER BY id"
+    )
+    media_type = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_rows(sql, params, fmt, str(request.base_url)),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=links.{fmt}"},
+    )
 
 
 @router.get("/{short_code}/stats", response_model=LinkStats)
-def get_stats(short_code: str):
-    conn = get_connection()
-    row = conn.execute("SELECT * FROM urls WHERE short_code = ?", (short_code,)).fetchone()
-    conn.close()
+async def get_stats(short_code: str, request: Request, response: Response):
+    # Clicks still buffered in this worker aren't in urls yet, so they go into the tag too.
+    pending = click_aggregator.pending(short_code)
+    shard = shard_for(short_code)
+    # The version is read before the row so the tag is never newer than the body it goes with.
+    version = await async_db.fetchone(conditional.VERSION_SQL, ("urls",), shard)
+    row = await async_db.fetchone(
+        "SELECT short_code, original_url, click_count, created_at FROM urls WHERE short_code = ?",
+        (short_code,),
+        shard,
+    )
     if not row:
         raise HTTPException(status_code=404, detail="Short code not found")
+    not_modified = conditional.check(request, response, version, short_code, pending)
+    if not_modified:
+        return not_modified
     return LinkStats(
         short_code=row["short_code"],
         original_url=row["original_url"],
-        click_count=row["click_count"],
+        click_count=row["click_count"] + pending,
         created_at=row["created_at"],
     )
 
 
+@router.get("/{short_code}/stats/timeseries", response_model=LinkTimeseries)
+def get_timeseries(
+    short_code: str,
+    granularity: str = Query(default="hour", pattern="^(hour|day)$"),
+    start: datetime | None = Query(default=None),
+    end: datetime | None = Query(default=None),
+    conn: sqlite3.Connection = Depends(get_link_db),
+):
+    if not conn.execute("SELECT 1 FROM urls WHERE short_code = ?", (short_code,)).fetchone():
+        raise HTTPException(status_code=404, detail="Short code not found")
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(seconds=48 * HOUR if granularity == "hour" else 30 * DAY)
+    buckets = click_events.timeseries(
+        conn, short_code, granularity, int(epoch(start)), int(epoch(end))
+    )
+    return LinkTimeseries(
+        short_code=short_code,
+        granularity=granularity,
+        buckets=[
+            ClickBucket(
+                bucket_start=datetime.fromtimestamp(bucket, timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+                count=count,
+            )
+            for bucket, count in buckets
+        ],
+    )
+
+
 @router.delete("/{short_code}", status_code=204)
-def delete_link(short_code: str):
-    conn = get_connection()
+def delete_link(short_code: str, conn: sqlite3.Connection = Depends(get_link_db)):
     row = conn.execute("SELECT 1 FROM urls WHERE short_code = ?", (short_code,)).fetchone()
     if not row:
-        conn.close()
         raise HTTPException(status_code=404, detail="Short code not found")
     conn.execute("DELETE FROM urls WHERE short_code = ?", (short_code,))
+    conn.execute("DELETE FROM click_rollups WHERE short_code = ?", (short_code,))
     conn.commit()
-    conn.close()
+    shared_table.delete(short_code)
+    link_cache.invalidate(short_code)
+    click_aggregator.discard(short_code)
@@ -1,29 +1,57 @@
+import os
+
 from fastapi import APIRouter, HTTPException
 from fastapi.responses import RedirectResponse
 
-from database import get_connection
+from admission import admission, degraded_total
+from async_db import async_db
+from bloom import short_code_filter
+from cache import link_cache
+from clicks import click_aggregator
+from database import shard_for
+from shared_table import shared_table
 
 router = APIRouter(tags=["redirect"])
 
+REDIRECT_CACHE_CONTROL = os.getenv("REDIRECT_CACHE_CONTROL", "")
+PERMANENT_MAX_AGE = int(os.getenv("PERMANENT_REDIRECT_MAX_AGE", "86400"))
+
 
 @router.get("/{short_code}")
-def redirect_to_url(short_code: str):
-    if short_code in ("health", "docs", "openapi.json", "api"):
+async def redirect_to_url(short_code: str):
+    if short_code in ("health", "metrics", "docs", "openapi.json", "api"):
         raise HTTPException(status_code=404)
 
-    conn = get_connection()
-    row = conn.execute(
-        "SELECT * FROM urls WHERE short_code = ?", (short_code,)
-    ).fetchone()
-
-    if not row:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Short code not found")
-
-    conn.execute(
-        "UPDATE urls SET click_count = click_count + 1 WHERE short_code = ?",
-        (short_code,),
-    )
-    conn.commit()
-    conn.close()
-    return RedirectResponse(url=row["original_url"], status_code=307)
+    # The shared table sees deletes from every worker; this worker's LRU would keep
+    # serving a deleted link until its TTL, so it's only used without the table.
+    shared = shared_table.ready
+    link = shared_table.get(short_code) if shared else link_cache.get(short_code)
+    if link is None:
+        if not short_code_filter.might_contain(short_code) and await short_code_filter.confirm_miss(short_code):
+            raise HTTPException(status_code=404, detail="Short code not found")
+        row = await async_db.fetchone(
+            "SELECT original_url, permanent FROM urls WHERE short_code = ?",
+            (short_code,),
+            shard_for(short_code),
+        )
+        if not row:
+            raise HTTPException(status_code=404, detail="Short code not found")
+        link = (row["original_url"], bool(row["permanent"]))
+        if not shared:
+            link_cache.set(short_code, link)
+
+    original_url, permanent = link
+    if admission.degraded():
+        # Writes are backed up; keep redirects fast and drop the click instead.
+        degraded_total.inc("click")
+    else:
+        click_aggregator.record(short_code)
+    if permanent:
+        # Browsers and proxies won't come back for these, so later clicks aren't counted.
+        return RedirectResponse(
+            url=original_url,
+            status_code=301,
+            headers={"Cache-Control": f"public, max-age={PERMANENT_MAX_AGE}, immutable"},
+        )
+    headers = {"Cache-Control": REDIRECT_CACHE_CONTROL} if REDIRECT_CACHE_CONTROL else None
+    return RedirectResponse(url=original_url, status_code=307, headers=headers)
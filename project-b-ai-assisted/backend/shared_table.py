@@ -0,0 +1,424 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import database
+
+TABLE_PATH = os.getenv("SHARED_TABLE_PATH", database.DB_PATH + ".codes")
+ENABLED = os.getenv("SHARED_TABLE_ENABLED", "1") == "1"
+MIN_SLOTS = int(os.getenv("SHARED_TABLE_MIN_SLOTS", "65536"))
+MIN_HEAP = int(os.getenv("SHARED_TABLE_MIN_HEAP", str(16 * 1024 * 1024)))
+MAX_LOAD = 0.7
+# Workers that start within this many seconds of a build reuse it instead of rebuilding.
+REUSE_WINDOW = 30.0
+
+MAGIC = b"SCT1"
+# magic, format, capacity, heap_size, heap_used, live, tombstones, retired, built_at
+HEADER = struct.Struct("<4sIQQQQQQd")
+HEADER_SIZE = 128
+# seq, tag, heap offset, key length, value length
+SLOT = struct.Struct("<IIIHH")
+SEQ = struct.Struct("<I")
+# Bumped on every put, even one that doesn't fit, so Bloom filters in other
+# workers can tell a new code may exist without querying SQLite.
+GENERATION = struct.Struct("<Q")
+GENERATION_OFFSET = HEADER.size
+# Set on the old table while a rebuild builds its replacement.
+JOURNALING = struct.Struct("<Q")
+JOURNALING_OFFSET = GENERATION_OFFSET + GENERATION.size
+CAPACITY = struct.Struct("<Q")
+TOMBSTONE = 0xFFFF
+READ_RETRIES = 64
+
+logger = logging.getLogger(__name__)
+
+
+def key_hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+class SharedTable:
+    """Memory-mapped short_code -> (original_url, permanent) hash table shared by all workers.
+
+    Readers never lock: every slot carries a sequence number that a writer makes
+    odd while it changes the slot, and readers retry when the number is odd or
+    moved under them. Key and URL bytes live in an append-only heap, so a slot
+    only ever points at bytes that are no longer written to. Writers across
+    processes are serialized with flock on a side file. A rebuild builds a new
+    file from SQLite while writers keep going and journal their changes, then
+    replays the journal under the write lock, renames the file over the old one
+    and flags the old mapping as retired so other workers reopen it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._mm = None
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._lock_fd = None
+        self._rebuild_lock = threading.Lock()
+        self._rebuild_fd = None
+        self._rebuilding = False
+
+    # -- reading ---------------------------------------------------------
+
+    @property
+    def ready(self) -> bool:
+        return self._mm is not None
+
+    def _header(self, mm):
+        return HEADER.unpack_from(mm, 0)
+
+    def _layout(self, mm):
+        capacity = CAPACITY.unpack_from(mm, 8)[0]
+        return capacity, HEADER_SIZE + capacity * SLOT.size
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            mm = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        if self._header(mm)[0] != MAGIC:
+            mm.close()
+            raise ValueError(f"{self.path} is not a short code table")
+        # Readers may still hold the previous mapping; it is unmapped once they drop it.
+        self._mm = mm
+
+    def _current(self):
+        mm = self._mm
+        if mm is not None and self._header(mm)[7]:
+            with self._open_lock:
+                if self._mm is mm:
+                    self._open()
+            mm = self._mm
+        return mm
+
+    def generation(self) -> int | None:
+        mm = self._current()
+        if mm is None:
+            return None
+        return GENERATION.unpack_from(mm, GENERATION_OFFSET)[0]
+
+    def get(self, short_code: str):
+        mm = self._current()
+        if mm is None:
+            return None
+        key = short_code.encode()
+        capacity, heap = self._layout(mm)
+        h = key_hash(key)
+        tag = h >> 32
+        mask = capacity - 1
+        index = h & mask
+        for _ in range(capacity):
+            offset = HEADER_SIZE + index * SLOT.size
+            for _ in range(READ_RETRIES):
+                seq, slot_tag, pos, klen, vlen = SLOT.unpack_from(mm, offset)
+                if seq & 1:
+                    continue
+                value = None
+                if klen == len(key) and slot_tag == tag:
+                    start = heap + pos
+                    if mm[start:start + klen] == key:
+                        value = mm[start + klen:start + klen + vlen]
+                if SEQ.unpack_from(mm, offset)[0] == seq:
+                    break
+            else:
+                self.misses += 1
+                return None
+            if value is not None:
+                self.hits += 1
+                return value[1:].decode(), value[0] == 1
+            if klen == 0:
+                break
+            index = (index + 1) & mask
+        self.misses += 1
+        return None
+
+    # -- writing ---------------------------------------------------------
+
+    @contextmanager
+    def _flock(self, lock, fd):
+        with lock:
+            if fcntl is not None and fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None and fd is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _write_lock(self):
+        return self._flock(self._lock, self._lock_fd)
+
+    def _write_slot(self, mm, offset, tag, pos, klen, vlen):
+        seq = SEQ.unpack_from(mm, offset)[0]
+        SEQ.pack_into(mm, offset, seq + 1)
+        SLOT.pack_into(mm, offset, seq + 1, tag, pos, klen, vlen)
+        SEQ.pack_into(mm, offset, seq + 2)
+
+    def _find(self, mm, key: bytes):
+        """Return (slot offset of key or None, first reusable slot offset)."""
+        capacity, heap = self._layout(mm)
+        h = key_hash(key)
+        tag = h >> 32
+        mask = capacity - 1
+        index = h & mask
+        free = None
+        for _ in range(capacity):
+            offset = HEADER_SIZE + index * SLOT.size
+            _, slot_tag, pos, klen, _ = SLOT.unpack_from(mm, offset)
+            if klen == 0:
+                return None, free if free is not None else offset
+            if klen == TOMBSTONE:
+                if free is None:
+                    free = offset
+            elif klen == len(key) and slot_tag == tag:
+                start = heap + pos
+                if mm[start:start + klen] == key:
+                    return offset, free
+            index = (index + 1) & mask
+        return None, free
+
+    def _journal(self, mm, *record):
+        # While a rebuild is building its file, writes are also recorded for it to replay.
+        if JOURNALING.unpack_from(mm, JOURNALING_OFFSET)[0]:
+            with open(self.path + ".journal", "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def _put(self, mm, key: bytes, value: bytes) -> bool:
+        magic, fmt, capacity, heap_size, heap_used, live, tombstones, retired, built_at = self._header(mm)
+        existing, free = self._find(mm, key)
+        grows = existing is None and free is not None and SLOT.unpack_from(mm, free)[3] == 0
+        full = heap_used + len(key) + len(value) > heap_size or (
+            grows and live + tombstones + 1 > capacity * MAX_LOAD
+        )
+        if full or (existing is None and free is None):
+            return False
+        start = self._layout(mm)[1] + heap_used
+        mm[start:start + len(key) + len(value)] = key + value
+        tag = key_hash(key) >> 32
+        if existing is not None:
+            self._write_slot(mm, existing, tag, heap_used, len(key), len(value))
+        else:
+            if not grows:
+                tombstones -= 1
+            live += 1
+            self._write_slot(mm, free, tag, heap_used, len(key), len(value))
+        heap_used += len(key) + len(value)
+        HEADER.pack_into(
+            mm, 0, magic, fmt, capacity, heap_size, heap_used, live, tombstones, retired, built_at
+        )
+        return True
+
+    def _delete(self, mm, key: bytes):
+        offset, _ = self._find(mm, key)
+        if offset is None:
+            return
+        _, tag, pos, _, vlen = SLOT.unpack_from(mm, offset)
+        self._write_slot(mm, offset, tag, pos, TOMBSTONE, vlen)
+        header = list(self._header(mm))
+        header[5] -= 1
+        header[6] += 1
+        HEADER.pack_into(mm, 0, *header)
+
+    def put(self, short_code: str, original_url: str, permanent: bool = False) -> bool:
+        if self._mm is None:
+            return False
+        key, value = short_code.encode(), bytes((permanent,)) + original_url.encode()
+        with self._write_lock():
+            mm = self._current()
+            GENERATION.pack_into(mm, GENERATION_OFFSET, GENERATION.unpack_from(mm, GENERATION_OFFSET)[0] + 1)
+            self._journal(mm, "put", short_code, original_url, permanent)
+            if len(value) >= TOMBSTONE:
+                return False
+            if not self._put(mm, key, value):
+                self._schedule_rebuild(mm)
+                return False
+        return True
+
+    def delete(self, short_code: str):
+        if self._mm is None:
+            return
+        with self._write_lock():
+            mm = self._current()
+            self._journal(mm, "delete", short_code)
+            self._delete(mm, short_code.encode())
+
+    # -- building --------------------------------------------------------
+
+    def _build_file(self, path: str, rows, count: int, data_bytes: int):
+        capacity = 1
+        while capacity < max(int(count / MAX_LOAD * 1.5), MIN_SLOTS):
+            capacity *= 2
+        heap_size = max(data_bytes * 2, MIN_HEAP)
+        heap_start = HEADER_SIZE + capacity * SLOT.size
+        with open(path, "wb") as f:
+            f.truncate(heap_start + heap_size)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            mm = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        mask = capacity - 1
+        heap_used = live = 0
+        for code, url, permanent in rows:
+            key, value = code.encode(), bytes((permanent,)) + url.encode()
+            h = key_hash(key)
+            index = h & mask
+            while SLOT.unpack_from(mm, HEADER_SIZE + index * SLOT.size)[3] != 0:
+                index = (index + 1) & mask
+            start = heap_start + heap_used
+            mm[start:start + len(key) + len(value)] = key + value
+            SLOT.pack_into(mm, HEADER_SIZE + index * SLOT.size, 0, h >> 32, heap_used, len(key), len(value))
+            heap_used += len(key) + len(value)
+            live += 1
+        HEADER.pack_into(mm, 0, MAGIC, 1, capacity, heap_size, heap_used, live, 0, 0, time.time())
+        return mm
+
+    def _rows(self):
+        for shard_pool in database.pools:
+            with shard_pool.connection() as conn:
+                yield from conn.execute("SELECT short_code, original_url, permanent FROM urls")
+
+    def _replay(self, mm, journal: str):
+        if not os.path.exists(journal):
+            return
+        with open(journal) as f:
+            for line in f:
+                op, short_code, *rest = json.loads(line)
+                if op == "delete":
+                    self._delete(mm, short_code.encode())
+                    continue
+                original_url, permanent = rest
+                value = bytes((permanent,)) + original_url.encode()
+                # A write that doesn't fit the new table is still served from SQLite.
+                if len(value) < TOMBSTONE and not self._put(mm, short_code.encode(), value):
+                    self._delete(mm, short_code.encode())
+
+    def rebuild(self, full=None):
+        """Rebuild the table from SQLite; with ``full``, only if that mapping is still current."""
+        with self._flock(self._rebuild_lock, self._rebuild_fd):
+            if full is None or self._current() is full:
+                self._rebuild()
+        self._rebuilding = False
+
+    def _rebuild(self):
+        # Journaling starts before the snapshot, so every write the snapshot may miss is
+        # replayed; only the replay and the rename hold the write lock.
+        journal = self.path + ".journal"
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        old = self._current()
+        with self._write_lock():
+            if old is not None:
+                JOURNALING.pack_into(old, JOURNALING_OFFSET, 1)
+            open(journal, "w").close()
+        try:
+            count = data_bytes = 0
+            for shard_pool in database.pools:
+                with shard_pool.connection() as conn:
+                    shard_count, shard_bytes = conn.execute(
+                        "SELECT COUNT(*), COALESCE(SUM(length(CAST(short_code AS BLOB))"
+                        " + length(CAST(original_url AS BLOB)) + 1), 0) FROM urls"
+                    ).fetchone()
+                count += shard_count
+                data_bytes += shard_bytes
+            mm = self._build_file(tmp, self._rows(), count, data_bytes)
+        except BaseException:
+            with self._write_lock():
+                if old is not None:
+                    JOURNALING.pack_into(old, JOURNALING_OFFSET, 0)
+                self._remove(journal, tmp)
+            raise
+        with self._write_lock():
+            try:
+                self._replay(mm, journal)
+                # A new table must not repeat a generation a filter may have seen.
+                generation = time.time_ns()
+                if old is not None:
+                    generation = GENERATION.unpack_from(old, GENERATION_OFFSET)[0] + 1
+                GENERATION.pack_into(mm, GENERATION_OFFSET, generation)
+                mm.flush()
+            finally:
+                mm.close()
+            os.replace(tmp, self.path)
+            if old is not None:
+                header = list(self._header(old))
+                header[7] = 1
+                HEADER.pack_into(old, 0, *header)
+            self._remove(journal)
+            self._open()
+
+    def _remove(self, *paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _schedule_rebuild(self, full):
+        if self._rebuilding:
+            return
+        self._rebuilding = True
+
+        def run():
+            try:
+                self.rebuild(full)
+            except Exception:
+                self._rebuilding = False
+                logger.exception("shared short code table rebuild failed")
+
+        threading.Thread(target=run, name="shared-table-rebuild", daemon=True).start()
+
+    def start(self):
+        if not ENABLED:
+            return
+        self._lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        self._rebuild_fd = os.open(self.path + ".rebuild.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        with self._flock(self._rebuild_lock, self._rebuild_fd):
+            if os.path.exists(self.path):
+                try:
+                    self._open()
+                except (ValueError, OSError, struct.error):
+                    self._mm = None
+            if self._mm is None or time.time() - self._header(self._mm)[8] >= REUSE_WINDOW:
+                self._rebuild()
+
+    def stop(self):
+        with self._lock:
+            if self._mm is not None:
+                self._mm.close()
+                self._mm = None
+            for fd in (self._lock_fd, self._rebuild_fd):
+                if fd is not None:
+                    os.close(fd)
+            self._lock_fd = self._rebuild_fd = None
+
+    def stats(self) -> dict:
+        mm = self._mm
+        if mm is None:
+            return {"ready": False, "capacity": 0, "live": 0, "hits": self.hits, "misses": self.misses}
+        header = self._header(mm)
+        return {
+            "ready": True,
+            "capacity": header[2],
+            "live": header[5],
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+shared_table = SharedTable(TABLE_PATH)
@@ -1,25 +1,56 @@
+import asyncio
+import csv
+import io
+import json
+import subprocess
 import sys
+import time
+import threading
 import os
+import httpx
 import pytest
 from fastapi.testclient import TestClient
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
 
 from main import app
-from database import DB_PATH, init_db, get_connection
+import fastjson
+import database
+from metrics import query_duration
+from database import DB_PATH, init_db, get_connection, pool
+from admission import Limiter, admission
+from analytics import DAY, HOUR, click_events
+from async_db import async_db
+from bloom import BloomFilter, short_code_filter
+from cache import link_cache
+import clicks
+from clicks import click_aggregator
+from codes import SequenceAllocator, allocator, base62
+import shared_table as shared_table_module
+from shared_table import SharedTable, shared_table
 
 client = TestClient(app, follow_redirects=False)
 HEADERS = {"X-API-Key": "dev-api-key"}
 
 
+@pytest.fixture(autouse=True, scope="module")
+def close_async_db():
+    yield
+    asyncio.run(async_db.close())
+
+
 @pytest.fixture(autouse=True)
 def clean_db():
     init_db()
     yield
+    click_aggregator.flush()
     conn = get_connection()
     conn.execute("DELETE FROM urls")
+    conn.execute("DELETE FROM click_rollups")
     conn.commit()
     conn.close()
+    link_cache.clear()
+    short_code_filter.reset()
 
 
 def test_health():
@@ -154,3 +185,855 @@ def test_redirect_is_public():
     )
     r = client.get("/public")
     assert r.status_code == 307
+
+
+def test_redirect_served_from_cache():
+    client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/hot", "custom_code": "hotlink"},
+        headers=HEADERS,
+    )
+    client.get("/hotlink")
+    r = client.get("/hotlink")
+    assert r.status_code == 307
+    assert r.headers["location"] == "https://example.com/hot"
+    stats = link_cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+
+
+def test_delete_invalidates_cache():
+    client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/gone", "custom_code": "gonenow"},
+        headers=HEADERS,
+    )
+    assert client.get("/gonenow").status_code == 307
+    client.delete("/api/links/gonenow", headers=HEADERS)
+    r = client.get("/gonenow")
+    assert r.status_code == 404
+
+
+def test_clicks_flushed_in_batch():
+    client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/batch", "custom_code": "batched"},
+        headers=HEADERS,
+    )
+    for _ in range(3):
+        client.get("/batched")
+    assert click_aggregator.pending("batched") == 3
+    click_aggregator.flush()
+    assert click_aggregator.pending("batched") == 0
+    conn = get_connection()
+    row = conn.execute("SELECT click_count FROM urls WHERE short_code = 'batched'").fetchone()
+    conn.close()
+    assert row["click_count"] == 3
+    r = client.get("/api/links/batched/stats", headers=HEADERS)
+    assert r.json()["click_count"] == 3
+
+
+def test_clicks_flushed_on_shutdown():
+    with TestClient(app, follow_redirects=False) as c:
+        c.post(
+            "/api/links",
+            json={"original_url": "https://example.com/shutdown", "custom_code": "lastone"},
+            headers=HEADERS,
+        )
+        c.get("/lastone")
+    conn = get_connection()
+    row = conn.execute("SELECT click_count FROM urls WHERE short_code = 'lastone'").fetchone()
+    conn.close()
+    assert row["click_count"] == 1
+
+
+def test_connections_reused_from_pool():
+    before = pool.stats()
+    for i in range(5):
+        client.post("/api/links", json={"original_url": f"https://pool.com/{i}"}, headers=HEADERS)
+    after = pool.stats()
+    # One checkout for the duplicate-URL lookup, one for the insert on the code's shard.
+    assert after["acquired"] - before["acquired"] == 10
+    assert after["open"] <= max(before["open"], 1)
+
+
+def test_bulk_create_json():
+    client.post(
+        "/api/links",
+        json={"original_url": "https://bulk.com/old", "custom_code": "oldone"},
+        headers=HEADERS,
+    )
+    r = client.post(
+        "/api/links/bulk",
+        json=[
+            {"original_url": "https://bulk.com/a"},
+            {"original_url": "https://bulk.com/old"},
+            {"original_url": "https://bulk.com/a"},
+            {"original_url": "https://bulk.com/b", "custom_code": "oldone"},
+            {"original_url": "not-a-url"},
+            {"original_url": "https://bulk.com/c", "custom_code": "bulkc"},
+        ],
+        headers=HEADERS,
+    )
+    assert r.status_code == 200
+    results = r.json()
+    assert [item["status"] for item in results] == [
+        "created", "existing", "existing", "conflict", "invalid", "created",
+    ]
+    assert results[1]["link"]["short_code"] == "oldone"
+    assert results[2]["link"]["short_code"] == results[0]["link"]["short_code"]
+    assert results[5]["link"]["short_code"] == "bulkc"
+    assert client.get("/bulkc").status_code == 307
+
+
+def test_bulk_create_ndjson():
+    body = "\n".join([
+        '{"original_url": "https://bulk.com/n1"}',
+        "{broken",
+        '{"original_url": "https://bulk.com/n2", "custom_code": "ndjson2"}',
+    ])
+    r = client.post(
+        "/api/links/bulk",
+        content=body,
+        headers={**HEADERS, "Content-Type": "application/x-ndjson"},
+    )
+    assert r.status_code == 200
+    results = r.json()
+    assert [item["index"] for item in results] == [0, 1, 2]
+    assert [item["status"] for item in results] == ["created", "invalid", "created"]
+    r = client.get("/api/links", headers=HEADERS)
+    assert len(r.json()) == 2
+
+
+def test_bulk_dedupes_across_chunks(monkeypatch):
+    import routes.links
+    monkeypatch.setattr(routes.links, "BULK_CHUNK_SIZE", 2)
+    urls = ["https://chunk.com/1", "https://chunk.com/2", "https://chunk.com/1"]
+    r = client.post(
+        "/api/links/bulk", json=[{"original_url": u} for u in urls], headers=HEADERS
+    )
+    results = r.json()
+    assert [item["status"] for item in results] == ["created", "created", "existing"]
+    assert results[2]["link"]["short_code"] == results[0]["link"]["short_code"]
+
+
+def test_bulk_rejects_non_array():
+    r = client.post("/api/links/bulk", json={"original_url": "https://bulk.com"}, headers=HEADERS)
+    assert r.status_code == 400
+
+
+def test_migrations_upgrade_existing_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "old.db"))
+    conn = get_connection()
+    conn.execute(database.MIGRATIONS[0][0])
+    conn.execute("INSERT INTO urls (short_code, original_url) VALUES ('legacy', 'https://old.com')")
+    conn.commit()
+    conn.close()
+    init_db()
+    init_db()
+    conn = get_connection()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(database.MIGRATIONS)
+    row = conn.execute("SELECT url_hash FROM urls WHERE short_code = 'legacy'").fetchone()
+    assert row["url_hash"] == database.url_hash("https://old.com")
+    plan = conn.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM urls WHERE url_hash = ? AND original_url = ?", (1, "x")
+    ).fetchall()
+    assert any("idx_urls_url_hash" in r["detail"] for r in plan)
+    indexes = {r["name"] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"idx_urls_created_at", "idx_urls_updated_at"} <= indexes
+    conn.close()
+
+
+def test_sequence_codes_are_unique():
+    alloc = SequenceAllocator("test-secret", 100)
+    permuted = {alloc.permute(n) for n in range(5000)}
+    assert len(permuted) == 5000
+    codes = {base62(n) for n in permuted}
+    assert len(codes) == 5000
+    assert all(len(c) == 6 for c in codes)
+
+
+def test_generated_code_skips_taken_custom_code(monkeypatch):
+    upcoming = iter(["clash1", "fresh1"])
+    monkeypatch.setattr(allocator, "next_code", lambda: next(upcoming))
+    client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/first", "custom_code": "clash1"},
+        headers=HEADERS,
+    )
+    r = client.post("/api/links", json={"original_url": "https://example.com/second"}, headers=HEADERS)
+    assert r.status_code == 201
+    assert r.json()["short_code"] == "fresh1"
+
+
+def test_export_ndjson_with_filters():
+    client.post(
+        "/api/links",
+        json={"original_url": "https://export.com/a", "custom_code": "expa"},
+        headers=HEADERS,
+    )
+    client.post(
+        "/api/links",
+        json={"original_url": "https://export.com/b", "custom_code": "expb"},
+        headers=HEADERS,
+    )
+    client.get("/expb")
+    r = client.get("/api/links/export?format=ndjson", headers=HEADERS)
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in r.text.splitlines()]
+    assert {line["short_code"] for line in lines} == {"expa", "expb"}
+    r = client.get("/api/links/export?min_clicks=1", headers=HEADERS)
+    lines = [json.loads(line) for line in r.text.splitlines()]
+    assert [(line["short_code"], line["click_count"]) for line in lines] == [("expb", 1)]
+    r = client.get("/api/links/export?created_after=2999-01-01", headers=HEADERS)
+    assert r.text == ""
+    # An ISO timestamp earlier the same day still includes the link.
+    day = lines[0]["created_at"][:10]
+    r = client.get(f"/api/links/export?created_after={day}T00:00:00", headers=HEADERS)
+    assert "expb" in {json.loads(line)["short_code"] for line in r.text.splitlines()}
+    r = client.get(f"/api/links/export?created_after={day}T00:00:00%2B00:00", headers=HEADERS)
+    assert "expb" in {json.loads(line)["short_code"] for line in r.text.splitlines()}
+    assert client.get("/api/links/export?created_after=yesterday", headers=HEADERS).status_code == 422
+
+
+def test_export_csv():
+    client.post(
+        "/api/links",
+        json={"original_url": "https://export.com/csv", "custom_code": "expcsv"},
+        headers=HEADERS,
+    )
+    r = client.get("/api/links/export?format=csv", headers=HEADERS)
+    assert r.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(r.text)))
+    assert rows[0]["short_code"] == "expcsv"
+    assert rows[0]["short_url"].endswith("/expcsv")
+
+
+def test_export_rejects_unknown_format():
+    r = client.get("/api/links/export?format=xml", headers=HEADERS)
+    assert r.status_code == 422
+
+
+def test_timeseries_from_rollups():
+    client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/series", "custom_code": "series"},
+        headers=HEADERS,
+    )
+    client.get("/series")
+    client.get("/series")
+    click_aggregator.flush()
+    r = client.get("/api/links/series/stats/timeseries?granularity=hour", headers=HEADERS)
+    assert r.status_code == 200
+    buckets = r.json()["buckets"]
+    assert len(buckets) == 1
+    assert buckets[0]["count"] == 2
+    assert buckets[0]["bucket_start"].endswith(":00:00")
+    r = client.get("/api/links/series/stats/timeseries?granularity=day", headers=HEADERS)
+    assert r.json()["buckets"][0]["count"] == 2
+    assert r.json()["buckets"][0]["bucket_start"].endswith("00:00:00")
+
+
+def test_deleted_code_drops_buffered_clicks():
+    def recreate():
+        client.post("/api/links", json={"original_url": "https://example.com/promo", "custom_code": "promo"}, headers=HEADERS)
+
+    recreate()
+    for _ in range(5):
+        client.get("/promo")
+    assert client.delete("/api/links/promo", headers=HEADERS).status_code == 204
+    recreate()
+    click_aggregator.flush()
+    assert client.get("/api/links/promo/stats", headers=HEADERS).json()["click_count"] == 0
+    r = client.get("/api/links/promo/stats/timeseries", headers=HEADERS)
+    assert r.json()["buckets"] == []
+
+
+def test_delete_during_flush_drops_clicks(monkeypatch):
+    client.post("/api/links", json={"original_url": "https://example.com/inflight", "custom_code": "inflight"}, headers=HEADERS)
+    for _ in range(3):
+        client.get("/inflight")
+    writing, release = threading.Event(), threading.Event()
+    shard_for = clicks.shard_for
+
+    def slow_shard_for(code):
+        writing.set()
+        release.wait(5)
+        return shard_for(code)
+
+    # The flush has taken the events but not written them yet when the delete arrives.
+    monkeypatch.setattr(clicks, "shard_for", slow_shard_for)
+    flusher = threading.Thread(target=click_aggregator.flush)
+    flusher.start()
+    assert writing.wait(5)
+    # The delete doesn't wait on the flush (or a second pool connection).
+    assert client.delete("/api/links/inflight", headers=HEADERS).status_code == 204
+    release.set()
+    flusher.join()
+    with pool.connection() as conn:
+        assert conn.execute("SELECT count(*) FROM click_rollups WHERE short_code = 'inflight'").fetchone()[0] == 0
+
+
+def test_timeseries_not_found():
+    r = client.get("/api/links/nope/stats/timeseries", headers=HEADERS)
+    assert r.status_code == 404
+
+
+def test_rollup_compaction_and_retention():
+    now = 1_700_000_000
+    old = now - 20 * DAY
+    ancient = now - 1000 * DAY
+    conn = get_connection()
+    conn.execute("INSERT INTO urls (short_code, original_url) VALUES ('cmp', 'https://example.com/cmp')")
+    click_events.write_rollups(conn, [("cmp", old), ("cmp", old + HOUR), ("cmp", now), ("cmp", ancient)])
+    click_events.compact(conn, now=now)
+    conn.commit()
+    rows = conn.execute(
+        "SELECT granularity, bucket_start, count FROM click_rollups WHERE short_code = 'cmp'"
+        " ORDER BY bucket_start"
+    ).fetchall()
+    conn.close()
+    assert [tuple(r) for r in rows] == [
+        ("day", old - old % DAY, 2),
+        ("hour", now - now % HOUR, 1),
+    ]
+
+
+def test_concurrent_async_redirects():
+    client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/many", "custom_code": "manyhits"},
+        headers=HEADERS,
+    )
+    link_cache.clear()
+
+    async def hammer():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            return await asyncio.gather(*(ac.get("/manyhits") for _ in range(200)))
+
+    responses = asyncio.run(hammer())
+    assert all(r.status_code == 307 for r in responses)
+    r = client.get("/api/links/manyhits/stats", headers=HEADERS)
+    assert r.json()["click_count"] == 200
+
+
+def test_metrics_endpoint():
+    client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/metrics", "custom_code": "metered"},
+        headers=HEADERS,
+    )
+    client.get("/metered")
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain")
+    body = r.text
+    assert 'http_request_duration_seconds_count{method="GET",handler="redirect_to_url",status="307"}' in body
+    assert 'sqlite_query_duration_seconds_count{statement="insert urls"}' in body
+    assert "redirect_cache_misses_total" in body
+    assert "db_pool_open_connections" in body
+    assert 'app_stage_duration_seconds_count{stage="serialize"}' in body
+    assert 'app_stage_duration_seconds_count{stage="connection_open"}' in body
+
+
+def test_query_time_includes_fetching():
+    conn = get_connection()
+    conn.create_function("nap", 1, lambda value: time.sleep(0.01) or value)
+    label = ("select json_each",)
+    before = query_duration._series.get(label, [None, 0.0, 0])[1:]
+    # Rows are computed while they're fetched, so most of the time is spent in fetchall().
+    rows = conn.execute("SELECT nap(value) FROM json_each('[1, 2, 3, 4, 5]')").fetchall()
+    assert len(rows) == 5
+    for row in conn.execute("SELECT nap(value) FROM json_each('[1, 2]')"):
+        pass
+    conn.close()
+    total, count = query_duration._series[label][1:]
+    assert count - before[1] == 2
+    assert total - before[0] >= 0.07
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    codes = [f"code{i}" for i in range(1000)]
+    for code in codes:
+        bloom.add(code)
+    assert all(code in bloom for code in codes)
+    false_hits = sum(f"other{i}" in bloom for i in range(10000))
+    assert false_hits < 300
+
+
+def test_bloom_rejects_unknown_codes_without_db(monkeypatch):
+    client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/bloom", "custom_code": "known"},
+        headers=HEADERS,
+    )
+    short_code_filter.rebuild()
+    client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/bloom2", "custom_code": "addedlater"},
+        headers=HEADERS,
+    )
+
+    async def no_db(*args):
+        raise AssertionError("database should not be queried")
+
+    monkeypatch.setattr(async_db, "fetchone", no_db)
+    r = client.get("/wp-login.php")
+    assert r.status_code == 404
+    assert short_code_filter.stats()["rejected"] == 1
+    monkeypatch.undo()
+    assert client.get("/known").status_code == 307
+    assert client.get("/addedlater").status_code == 307
+
+
+def test_bloom_picks_up_codes_from_other_writers(tmp_path, monkeypatch):
+    import bloom
+
+    async def no_db(*args):
+        raise AssertionError("database should not be queried")
+
+    def insert_elsewhere(code):
+        conn = get_connection()
+        conn.execute("INSERT INTO urls (short_code, original_url) VALUES (?, 'https://other.com')", (code,))
+        conn.commit()
+        conn.close()
+
+    monkeypatch.setattr(shared_table, "path", str(tmp_path / "urls.codes"))
+    shared_table.start()
+    try:
+        short_code_filter.rebuild()
+        before = short_code_filter.stats()
+        # Definite misses are answered from memory while the table's generation is unchanged.
+        with monkeypatch.context() as m:
+            m.setattr(async_db, "fetchall", no_db)
+            m.setattr(async_db, "fetchone", no_db)
+            assert all(client.get(f"/junk{i}").status_code == 404 for i in range(50))
+        assert short_code_filter.stats()["catch_ups"] == before["catch_ups"]
+
+        # Another worker created a link but its table put didn't fit; the generation still moved.
+        insert_elsewhere("otherwkr")
+        assert not shared_table.put("otherwkr", "https://other.com/" + "x" * 70000)
+        assert not short_code_filter.might_contain("otherwkr")
+        assert client.get("/otherwkr").status_code == 307
+        assert short_code_filter.stats()["catch_ups"] == before["catch_ups"] + 1
+        assert client.get("/junk0").status_code == 404
+        assert short_code_filter.stats()["catch_ups"] == before["catch_ups"] + 1
+    finally:
+        shared_table.stop()
+
+    # Without the shared table, a miss only syncs once the filter is older than MAX_STALENESS.
+    short_code_filter.rebuild()
+    insert_elsewhere("nosharetbl")
+    assert client.get("/nosharetbl").status_code == 404
+    monkeypatch.setattr(bloom, "MAX_STALENESS", 0.0)
+    assert client.get("/nosharetbl").status_code == 307
+
+
+def test_shared_table_lookups(tmp_path):
+    client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/shm", "custom_code": "shm1"},
+        headers=HEADERS,
+    )
+    table = SharedTable(str(tmp_path / "urls.codes"))
+    assert table.get("shm1") is None
+    table.start()
+    try:
+        assert table.get("shm1") == ("https://example.com/shm", False)
+        assert table.put("shm2", "https://example.com/two")
+        assert table.put("shm2", "https://example.com/two-moved", permanent=True)
+        assert table.get("shm2") == ("https://example.com/two-moved", True)
+        table.delete("shm1")
+        assert table.get("shm1") is None
+        assert table.put("shm1", "https://example.com/back")
+        assert table.get("shm1") == ("https://example.com/back", False)
+        assert table.stats()["live"] == 2
+
+        backend = os.path.join(os.path.dirname(__file__), "..", "backend")
+        script = (
+            f"import sys; sys.path.insert(0, {backend!r}); from shared_table import SharedTable;"
+            f"t = SharedTable({table.path!r}); t._open(); print(t.get('shm2')[0])"
+        )
+        out = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        assert out.stdout.strip() == "https://example.com/two-moved"
+    finally:
+        table.stop()
+
+
+def test_shared_table_rebuilds_when_full(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared_table_module, "MIN_SLOTS", 8)
+    monkeypatch.setattr(shared_table_module, "MIN_HEAP", 256)
+    path = str(tmp_path / "urls.codes")
+    writer, reader = SharedTable(path), SharedTable(path)
+    writer.start()
+    reader._open()
+    try:
+        monkeypatch.setattr(writer, "_schedule_rebuild", lambda full: None)
+        conn = get_connection()
+        n = 0
+        while writer.put(f"fill{n}", "https://filler.example.com"):
+            conn.execute(
+                "INSERT INTO urls (short_code, original_url) VALUES (?, ?)",
+                (f"fill{n}", "https://filler.example.com"),
+            )
+            n += 1
+        conn.execute("INSERT INTO urls (short_code, original_url) VALUES ('late1', 'https://example.com/late')")
+        conn.commit()
+        conn.close()
+        assert reader.get("late1") is None
+        writer.rebuild()
+        assert writer.stats()["capacity"] > 8
+        # The old file was replaced; the reader notices and reopens the new one.
+        assert reader.get("late1") == ("https://example.com/late", False)
+    finally:
+        writer.stop()
+        reader.stop()
+
+
+def test_shared_table_writes_during_rebuild(tmp_path):
+    client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/gone", "custom_code": "rbgone"},
+        headers=HEADERS,
+    )
+    path = str(tmp_path / "urls.codes")
+    writer, other = SharedTable(path), SharedTable(path)
+    writer.start()
+    other.start()
+    building, release = threading.Event(), threading.Event()
+    rows = writer._rows
+
+    def slow_rows():
+        building.set()
+        assert release.wait(5)
+        yield from rows()
+
+    writer._rows = slow_rows
+    rebuild = threading.Thread(target=writer.rebuild)
+    rebuild.start()
+    try:
+        assert building.wait(5)
+        # Another worker's writes don't wait for the snapshot and build.
+        started = time.monotonic()
+        assert other.put("rbnew", "https://example.com/new")
+        other.delete("rbgone")
+        assert time.monotonic() - started < 1
+        release.set()
+        rebuild.join(5)
+        assert not rebuild.is_alive()
+        assert other.get("rbnew") == ("https://example.com/new", False)
+        assert other.get("rbgone") is None
+        assert writer.get("rbnew") == ("https://example.com/new", False)
+        assert not os.path.exists(path + ".journal")
+    finally:
+        release.set()
+        writer.stop()
+        other.stop()
+
+
+def test_redirect_served_from_shared_table(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared_table, "path", str(tmp_path / "urls.codes"))
+    shared_table.start()
+    try:
+        client.post(
+            "/api/links",
+            json={"original_url": "https://example.com/shared", "custom_code": "shared1"},
+            headers=HEADERS,
+        )
+        link_cache.clear()
+
+        async def no_db(*args):
+            raise AssertionError("database should not be queried")
+
+        with monkeypatch.context() as m:
+            m.setattr(async_db, "fetchone", no_db)
+            r = client.get("/shared1")
+        assert r.status_code == 307
+        assert r.headers["location"] == "https://example.com/shared"
+
+        client.delete("/api/links/shared1", headers=HEADERS)
+        assert shared_table.get("shared1") is None
+        assert client.get("/shared1").status_code == 404
+
+        # A delete on another worker only reaches this one through the shared table.
+        client.post(
+            "/api/links",
+            json={"original_url": "https://example.com/elsewhere", "custom_code": "shared2"},
+            headers=HEADERS,
+        )
+        link_cache.set("shared2", ("https://example.com/elsewhere", False))
+        conn = get_connection()
+        conn.execute("DELETE FROM urls WHERE short_code = 'shared2'")
+        conn.commit()
+        conn.close()
+        shared_table.delete("shared2")
+        before = link_cache.stats()
+        assert client.get("/shared2").status_code == 404
+        assert link_cache.stats()["misses"] == before["misses"]
+    finally:
+        shared_table.stop()
+
+
+def test_list_links_conditional_get(monkeypatch):
+    client.post("/api/links", json={"original_url": "https://example.com/etag"}, headers=HEADERS)
+    r = client.get("/api/links", headers=HEADERS)
+    etag = r.headers["etag"]
+    # Last-Modified is held back until its second has passed.
+    assert "last-modified" not in r.headers
+    conn = get_connection()
+    conn.execute("UPDATE table_versions SET updated_at = datetime('now', '-5 seconds') WHERE name = 'urls'")
+    conn.commit()
+    conn.close()
+    r = client.get("/api/links", headers=HEADERS)
+    modified = r.headers["last-modified"]
+    assert client.get("/api/links", headers={**HEADERS, "If-Modified-Since": modified}).status_code == 304
+
+    def no_rows(*args):
+        raise AssertionError("rows should not be built")
+
+    with monkeypatch.context() as m:
+        m.setattr("routes.links.row_to_response", no_rows)
+        r = client.get("/api/links", headers={**HEADERS, "If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.content == b""
+
+    client.post("/api/links", json={"original_url": "https://example.com/etag2"}, headers=HEADERS)
+    r = client.get("/api/links", headers={**HEADERS, "If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["etag"] != etag
+    assert len(r.json()) == 2
+    assert client.get("/api/links", headers={**HEADERS, "If-Modified-Since": modified}).status_code == 200
+
+
+def test_fast_json_matches_model_path(monkeypatch):
+    client.post("/api/links", json={"original_url": "https://example.com/fast"}, headers=HEADERS)
+    client.post(
+        "/api/links", json={"original_url": "https://example.com/fast2", "permanent": True}, headers=HEADERS
+    )
+    slow = client.get("/api/links", headers=HEADERS)
+    monkeypatch.setattr(fastjson, "ENABLED", True)
+    fast = client.get("/api/links", headers=HEADERS)
+    assert fast.json() == slow.json()
+    assert fast.headers["etag"] == slow.headers["etag"]
+    assert fast.headers["content-type"] == "application/json"
+
+
+def test_stats_etag_changes_with_clicks():
+    code = client.post(
+        "/api/links", json={"original_url": "https://example.com/stats-etag"}, headers=HEADERS
+    ).json()["short_code"]
+    etag = client.get(f"/api/links/{code}/stats", headers=HEADERS).headers["etag"]
+    r = client.get(f"/api/links/{code}/stats", headers={**HEADERS, "If-None-Match": etag})
+    assert r.status_code == 304
+
+    client.get(f"/{code}")
+    r = client.get(f"/api/links/{code}/stats", headers={**HEADERS, "If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.json()["click_count"] == 1
+    click_aggregator.flush()
+    r2 = client.get(f"/api/links/{code}/stats", headers={**HEADERS, "If-None-Match": r.headers["etag"]})
+    assert r2.status_code == 200
+    assert r2.json()["click_count"] == 1
+
+    # A missing code is a 404 whatever the precondition says.
+    assert client.get("/api/links/nosuchcode/stats", headers={**HEADERS, "If-None-Match": "*"}).status_code == 404
+
+
+def test_permanent_link_redirects_with_301():
+    r = client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/forever", "custom_code": "forever", "permanent": True},
+        headers=HEADERS,
+    )
+    assert r.json()["permanent"] is True
+    for _ in range(2):
+        r = client.get("/forever")
+        assert r.status_code == 301
+        assert r.headers["location"] == "https://example.com/forever"
+        assert "max-age=86400" in r.headers["cache-control"]
+
+    code = client.post(
+        "/api/links", json={"original_url": "https://example.com/temp"}, headers=HEADERS
+    ).json()["short_code"]
+    r = client.get(f"/{code}")
+    assert r.status_code == 307
+    assert "cache-control" not in r.headers
+
+
+@pytest.fixture
+def sharded(tmp_path, monkeypatch):
+    def switch(path, shards):
+        click_aggregator.flush()
+        asyncio.run(async_db.close())
+        for shard_pool in database.pools:
+            shard_pool.close()
+        monkeypatch.setattr(database, "DB_PATH", path)
+        database.set_shards(shards)
+        link_cache.clear()
+        short_code_filter.reset()
+
+    original = database.DB_PATH
+    switch(str(tmp_path / "urls.db"), 3)
+    init_db()
+    yield tmp_path
+    switch(original, 1)
+
+
+def test_links_spread_across_shards(sharded):
+    codes = []
+    for i in range(30):
+        r = client.post("/api/links", json={"original_url": f"https://shard.com/{i}"}, headers=HEADERS)
+        assert r.status_code == 201
+        codes.append(r.json()["short_code"])
+    assert {database.shard_for(code) for code in codes} == {0, 1, 2}
+
+    per_shard = []
+    for index in range(3):
+        conn = get_connection(database.shard_path(index))
+        per_shard.append(conn.execute("SELECT COUNT(*) FROM urls").fetchone()[0])
+        conn.close()
+    assert sum(per_shard) == 30 and all(per_shard)
+
+    links = client.get("/api/links", headers=HEADERS).json()
+    assert len(links) == 30
+    assert len({link["id"] for link in links}) == 30
+    created = [link["created_at"] for link in links]
+    assert created == sorted(created, reverse=True)
+
+    dup = client.post("/api/links", json={"original_url": "https://shard.com/7"}, headers=HEADERS)
+    assert dup.json()["short_code"] == codes[7]
+
+    for code in codes[:3]:
+        assert client.get(f"/{code}").status_code == 307
+    click_aggregator.flush()
+    assert client.get(f"/api/links/{codes[0]}/stats", headers=HEADERS).json()["click_count"] == 1
+    assert client.delete(f"/api/links/{codes[1]}", headers=HEADERS).status_code == 204
+    assert client.get(f"/{codes[1]}").status_code == 404
+
+    r = client.post(
+        "/api/links/bulk",
+        json=[{"original_url": f"https://bulk-shard.com/{i}"} for i in range(20)],
+        headers=HEADERS,
+    )
+    assert [item["status"] for item in r.json()] == ["created"] * 20
+    lines = client.get("/api/links/export", headers=HEADERS).text.splitlines()
+    ids = [json.loads(line)["id"] for line in lines]
+    assert len(ids) == 49 and ids == sorted(ids)
+
+
+def test_reshard_moves_links(sharded, monkeypatch):
+    import reshard
+
+    codes = []
+    for i in range(20):
+        r = client.post("/api/links", json={"original_url": f"https://reshard.com/{i}"}, headers=HEADERS)
+        codes.append(r.json()["short_code"])
+    client.get(f"/{codes[0]}")
+    click_aggregator.flush()
+    asyncio.run(async_db.close())
+    for shard_pool in database.pools:
+        shard_pool.close()
+
+    stale_table = database.DB_PATH + ".codes"
+    live_table = str(sharded / "live.codes")
+    for path in (stale_table, live_table):
+        open(path, "wb").close()
+    monkeypatch.setattr(shared_table_module, "TABLE_PATH", live_table)
+    reshard.reshard(3, 2, database.DB_PATH)
+    database.set_shards(2)
+    # Only the table next to the resharded files goes, not the one this process was started with.
+    assert not os.path.exists(stale_table)
+    assert os.path.exists(live_table)
+    assert not os.path.exists(database.shard_path(2))
+    assert os.path.exists(database.shard_path(2) + ".pre-reshard")
+
+    links = client.get("/api/links", headers=HEADERS).json()
+    assert sorted(link["short_code"] for link in links) == sorted(codes)
+    assert client.get(f"/api/links/{codes[0]}/stats", headers=HEADERS).json()["click_count"] == 1
+    assert client.get(f"/{codes[5]}").status_code == 307
+
+
+def test_limiter_queues_then_sheds():
+    async def scenario():
+        limiter = Limiter("test", concurrency=1, queue_size=1, budget=0.05)
+        assert await limiter.acquire()
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not await limiter.acquire()  # queue is full
+        limiter.release()
+        assert await waiting  # the slot was handed to the waiter
+        assert limiter.active == 1
+        assert not await limiter.acquire()  # waits out the 50ms budget
+        assert limiter.wait_avg > 0
+        limiter.wait_avg = 1.0
+        assert not await limiter.acquire()  # shed at once while the average is over budget
+        limiter.release()
+        assert limiter.active == 0
+        assert await limiter.acquire()
+
+    asyncio.run(scenario())
+
+
+def test_redirects_admitted_while_heavy_reads_are_full(monkeypatch):
+    client.post(
+        "/api/links",
+        json={"original_url": "https://example.com/flood", "custom_code": "flood"},
+        headers=HEADERS,
+    )
+    started, release = threading.Event(), threading.Event()
+
+    def slow_export(*args):
+        started.set()
+        release.wait(10)
+        yield ""
+
+    monkeypatch.setattr("routes.links.export_rows", slow_export)
+    heavy = admission.limiters["heavy"]
+    monkeypatch.setattr(heavy, "concurrency", 1)
+    monkeypatch.setattr(heavy, "queue_size", 0)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            export = asyncio.create_task(ac.get("/api/links/export", headers=HEADERS))
+            while not started.is_set():
+                await asyncio.sleep(0.01)
+            listing = await ac.get("/api/links", headers=HEADERS)
+            redirects = await asyncio.gather(*(ac.get("/flood") for _ in range(2000)))
+            release.set()
+            return await export, listing, redirects
+
+    try:
+        export, listing, redirects = asyncio.run(scenario())
+    finally:
+        release.set()
+    assert export.status_code == 200
+    assert listing.status_code == 503
+    assert all(r.status_code == 307 for r in redirects)
+    assert admission.route_class({"path": "/flood", "method": "GET"}) == "redirect"
+    assert admission.route_class({"path": "/api/links/flood/stats/timeseries", "method": "GET"}) == "heavy"
+    assert admission.route_class({"path": "/api/links/flood/stats", "method": "GET"}) == "read"
+    assert admission.route_class({"path": "/docs", "method": "GET"}) == "read"
+
+
+def test_overloaded_writes_get_503_and_redirects_skip_clicks(monkeypatch):
+    code = client.post(
+        "/api/links", json={"original_url": "https://example.com/busy"}, headers=HEADERS
+    ).json()["short_code"]
+    write = admission.limiters["write"]
+    with monkeypatch.context() as m:
+        m.setattr(write, "concurrency", 0)
+        m.setattr(write, "queue_size", 0)
+        r = client.post("/api/links", json={"original_url": "https://example.com/busy2"}, headers=HEADERS)
+        assert r.status_code == 503
+        assert r.headers["retry-after"] == "1"
+        assert client.get("/health").status_code == 200
+
+        assert client.get(f"/{code}").status_code == 307
+        assert click_aggregator.pending(code) == 0
+        assert 'admission_rejected_total{class="write",reason="queue_full"}' in client.get("/metrics").text
+    client.get(f"/{code}")
+    assert click_aggregator.pending(code) == 1